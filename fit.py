@@ -2,25 +2,84 @@
 
 from io import BytesIO as StringIO
 from struct import pack
-from struct import unpack
+from struct import unpack_from
+from struct import calcsize
+from struct import Struct
+from collections import namedtuple
 from datetime import datetime
+import mmap
+import os
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def _calcCRC(crc, byte):
-    table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
-             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
-    # compute checksum of lower four bits of byte
-    tmp = table[crc & 0xF]
-    crc = (crc >> 4) & 0x0FFF
-    crc = crc ^ tmp ^ table[byte & 0xF]
-    # now compute checksum of upper four bits of byte
-    tmp = table[crc & 0xF]
-    crc = (crc >> 4) & 0x0FFF
-    crc = crc ^ tmp ^ table[(byte >> 4) & 0xF]
+
+def _make_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+_CRC_TABLE = _make_crc_table()
+
+
+def _calcCRC(crc, data):
+    """update the FIT CRC-16 with a chunk of bytes"""
+    table = _CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
     return crc
 
 
+def _gf2_times(mat, vec):
+    s = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(16)]
+
+
+def _combineCRC(crc1, crc2, len2):
+    """CRC of A + B given crc1 = CRC(A), crc2 = CRC(B) and len2 = len(B)
+
+    the FIT CRC has no initial value nor final xor, so it is linear and
+    crc1 only has to be advanced over len2 zero bytes, which is done in
+    O(log len2) by squaring the single zero-bit operator (as zlib does)."""
+    if len2 <= 0:
+        return crc1
+    # operator for one zero bit
+    odd = [0xA001] + [1 << n for n in range(15)]
+    even = _gf2_square(odd)  # two zero bits
+    odd = _gf2_square(even)  # four zero bits
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
 class FitBaseType(object):
     """BaseType Definition
 
@@ -60,35 +119,234 @@ class FitBaseType(object):
 class Fit(object):
     HEADER_SIZE = 12
 
-    GMSG_NUMS = {
-        'file_id': 0,
-        'device_info': 23,
-        'weight_scale': 30,
-        'file_creator': 49,
+    # global messages: name -> (global message number, fields), every field
+    # is (name, field number, basetype, scale, offset) in definition order,
+    # stored values are (value + offset) * scale
+    PROFILE = {
+        'file_id': (0, (
+            ('serial_number', 3, FitBaseType.uint32z, None, None),
+            ('time_created', 4, FitBaseType.uint32, None, None),
+            ('manufacturer', 1, FitBaseType.uint16, None, None),
+            ('product', 2, FitBaseType.uint16, None, None),
+            ('number', 5, FitBaseType.uint16, None, None),
+            ('type', 0, FitBaseType.enum, None, None),
+        )),
+        'device_info': (23, (
+            ('timestamp', 253, FitBaseType.uint32, 1, None),
+            ('serial_number', 3, FitBaseType.uint32z, 1, None),
+            ('cum_operating_time', 7, FitBaseType.uint32, 1, None),
+            ('unknown', 8, FitBaseType.uint32, None, None),  # undocumented
+            ('manufacturer', 2, FitBaseType.uint16, 1, None),
+            ('product', 4, FitBaseType.uint16, 1, None),
+            ('software_version', 5, FitBaseType.uint16, 100, None),
+            ('battery_voltage', 10, FitBaseType.uint16, 256, None),
+            ('device_index', 0, FitBaseType.uint8, 1, None),
+            ('device_type', 1, FitBaseType.uint8, 1, None),
+            ('hardware_version', 6, FitBaseType.uint8, 1, None),
+            ('battery_status', 11, FitBaseType.uint8, None, None),
+        )),
+        'weight_scale': (30, (
+            ('timestamp', 253, FitBaseType.uint32, 1, None),
+            ('weight', 0, FitBaseType.uint16, 100, None),
+            ('percent_fat', 1, FitBaseType.uint16, 100, None),
+            ('percent_hydration', 2, FitBaseType.uint16, 100, None),
+            ('visceral_fat_mass', 3, FitBaseType.uint16, 100, None),
+            ('bone_mass', 4, FitBaseType.uint16, 100, None),
+            ('muscle_mass', 5, FitBaseType.uint16, 100, None),
+            ('basal_met', 7, FitBaseType.uint16, 4, None),
+            ('active_met', 9, FitBaseType.uint16, 4, None),
+            ('physique_rating', 8, FitBaseType.uint8, 1, None),
+            ('metabolic_age', 10, FitBaseType.uint8, 1, None),
+            ('visceral_fat_rating', 11, FitBaseType.uint8, 1, None),
+            ('bmi', 13, FitBaseType.uint16, 10, None),
+        )),
+        'blood_pressure': (51, (
+            ('timestamp', 253, FitBaseType.uint32, 1, None),
+            ('systolic_pressure', 0, FitBaseType.uint16, 1, None),
+            ('diastolic_pressure', 1, FitBaseType.uint16, 1, None),
+            ('mean_arterial_pressure', 2, FitBaseType.uint16, 1, None),
+            ('map_3_sample_mean', 3, FitBaseType.uint16, 1, None),
+            ('map_morning_values', 4, FitBaseType.uint16, 1, None),
+            ('map_evening_values', 5, FitBaseType.uint16, 1, None),
+            ('heart_rate', 6, FitBaseType.uint8, 1, None),
+            ('heart_rate_type', 7, FitBaseType.enum, None, None),
+            ('status', 8, FitBaseType.enum, None, None),
+            ('user_profile_index', 9, FitBaseType.uint16, None, None),
+        )),
+        'file_creator': (49, (
+            ('software_version', 0, FitBaseType.uint16, None, None),
+            ('hardware_version', 1, FitBaseType.uint8, None, None),
+        )),
     }
 
-
-class FitEncoder(Fit):
-    def timestamp(self, t):
-        """the timestamp in fit protocol is seconds since
-        UTC 00:00 Dec 31 1989 (631065600)"""
-        if isinstance(t, datetime):
-            t = time.mktime(t.timetuple())
-        return t - 631065600
+    GMSG_NUMS = dict((name, msg[0]) for name, msg in PROFILE.items())
+
+
+def _position(f):
+    """current position of f, None when it cannot seek (pipes, sockets).
+    Probed with tell/seek since not every file-like object has seekable(),
+    e.g. SpooledTemporaryFile before Python 3.11."""
+    seekable = getattr(f, 'seekable', None)
+    try:
+        if seekable is not None and not seekable():
+            return None
+        position = f.tell()
+        f.seek(position)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return position
+
+
+def _populated(column):
+    """whether a column carries at least one valid (not None/NaN) value"""
+    if column is None:
+        return False
+    if numpy is not None:
+        return not numpy.isnan(numpy.asarray(column, dtype=numpy.float64)).all()
+    return any(value is not None and value == value for value in column)
+
+
+class FitMessageDefinition(object):
+    """A message definition compiled once into its definition record and a
+    single struct covering the whole data record.
+
+    fields is a sequence of (name, field number, basetype, scale, offset) as
+    in Fit.PROFILE, records are little endian (architecture 0)."""
+
+    INTEGER_TYPES = (1, 2, 3, 4, 5, 6, 10, 11, 12)
+
+    def __init__(self, gmsg_num, lmsg_type, fields):
+        self.gmsg_num = gmsg_num
+        self.lmsg_type = lmsg_type
+        self.fields = tuple(fields)
+        self.names = tuple(field[0] for field in self.fields)
+
+        # record header (6th bit marks a definition), reserved, architecture, global number, field count
+        self.definition = b''.join(
+            [pack('<BBBHB', (1 << 6) | lmsg_type, 0, 0, gmsg_num, len(self.fields))] +
+            [pack('<BBB', num, basetype['size'], basetype['field']) for _, num, basetype, _, _ in self.fields])
+        self.struct = Struct('<B' + ''.join(FitBaseType.get_format(basetype) for _, _, basetype, _, _ in self.fields))
+        self.size = self.struct.size
+        self._converters = tuple((basetype['invalid'], scale, offset, basetype['#'] in self.INTEGER_TYPES)
+                                 for _, _, basetype, scale, offset in self.fields)
+        self._selections = {}
+
+    def select(self, names):
+        """definition restricted to the named fields (kept in definition
+        order), compiled once per selection"""
+        names = frozenset(names)
+        msg = self._selections.get(names)
+        if msg is None:
+            unknown = names.difference(self.names)
+            if unknown:
+                raise ValueError("unknown fields: %s" % ', '.join(sorted(unknown)))
+            msg = FitMessageDefinition(self.gmsg_num, self.lmsg_type,
+                                       [field for field in self.fields if field[0] in names])
+            self._selections[names] = msg
+        return msg
+
+    def pack(self, *values):
+        """one data record (record header included) as bytes"""
+        return self.struct.pack(*self._args(values))
+
+    def pack_into(self, buf, *values):
+        """pack one data record (record header included) at the start of
+        buf, a buffer of at least size bytes preallocated by the caller"""
+        self.struct.pack_into(buf, 0, *self._args(values))
+        return buf
+
+    def _args(self, values):
+        args = [self.lmsg_type]
+        for value, (invalid, scale, offset, integer) in zip(values, self._converters):
+            if value is None:
+                value = invalid
+            else:
+                if offset:
+                    value += offset
+                if scale is not None:
+                    value *= scale
+                if integer:
+                    value = int(value)
+            args.append(value)
+        return args
+
+    def pack_columns(self, columns, count):
+        """pack count data records at once from columns, one per field in
+        record order. A column is a sequence (None or NaN marks an invalid
+        value), a numpy array, or None when the field is absent altogether."""
+        if numpy is not None:
+            return self._pack_columns_numpy(columns, count)
+        buf = bytearray(self.size * count)
+        pack_into = self.struct.pack_into
+        rows = zip(*[[None] * count if column is None else column for column in columns])
+        for position, row in zip(range(0, len(buf), self.size), rows):
+            args = [self.lmsg_type]
+            for value, (invalid, scale, offset, integer) in zip(row, self._converters):
+                if value is None or value != value:
+                    value = invalid
+                else:
+                    if offset:
+                        value += offset
+                    if scale is not None:
+                        value *= scale
+                    if integer:
+                        value = int(value)
+                args.append(value)
+            pack_into(buf, position, *args)
+        return bytes(buf)
+
+    def _pack_columns_numpy(self, columns, count):
+        records = numpy.empty(count, dtype=self.numpy_dtype())
+        records['header'] = self.lmsg_type
+        for i, (column, (invalid, scale, offset, integer)) in enumerate(zip(columns, self._converters)):
+            name = 'f%d' % i
+            if column is None:
+                records[name] = invalid
+                continue
+            values = numpy.asarray(column, dtype=numpy.float64)
+            if offset:
+                values = values + offset
+            if scale is not None:
+                values = values * scale
+            values = numpy.where(numpy.isnan(values), invalid, values)
+            if integer:
+                values = numpy.trunc(values)
+            records[name] = values
+        return records.tobytes()
+
+    def numpy_dtype(self):
+        """structured numpy dtype with the same (packed) layout as the record"""
+        formats = {'B': 'u1', 'b': 'i1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4',
+                   'f': '<f4', 'd': '<f8', 'c': 'S1', 's': 'S1'}
+        return numpy.dtype([('header', 'u1')] + [
+            ('f%d' % i, formats[FitBaseType.get_format(basetype)])
+            for i, (_, _, basetype, _, _) in enumerate(self.fields)])
 
 
-class FitEncoder_Weight(FitEncoder):
-    FILE_TYPE = 9
-    LMSG_TYPE_FILE_INFO = 0
-    LMSG_TYPE_FILE_CREATOR = 1
-    LMSG_TYPE_DEVICE_INFO = 2
-    LMSG_TYPE_WEIGHT_SCALE = 3
-
-    def __init__(self):
-        self.buf = StringIO()
-        self.write_header()  # create header first
-        self.device_info_defined = False
-        self.weight_scale_defined = False
+class FitEncoder(Fit):
+    # local message types reserved for profile messages, others are
+    # assigned in order of first use
+    LOCAL_TYPES = {}
+
+    _definitions = {}  # compiled definitions by (message name, local type)
+
+    def __init__(self, sink=None, data_size=None):
+        """encode into sink, any writable file-like object (in memory by
+        default). The header is rewritten by finish() when the sink can seek,
+        otherwise (pipes, request bodies) the data_size must be given upfront,
+        see expected_data_size()."""
+        self.buf = StringIO() if sink is None else sink
+        self._start = _position(self.buf)
+        if self._start is None and data_size is None:
+            raise ValueError("data_size is required for a sink that cannot seek")
+        self._declared_size = data_size
+        self._crc = 0  # running crc of everything after the header
+        self._data_size = 0
+        self._finished = False
+        self._local_types = dict(self.LOCAL_TYPES)
+        self._defined = {}  # local type -> definition last written for it
+        self._records = {}  # definition -> record buffer reused by write_message
+        self.write_header(data_size=data_size or 0)  # create header first
 
     def __str__(self):
         orig_pos = self.buf.tell()
@@ -107,131 +365,81 @@ class FitEncoder_Weight(FitEncoder):
                      profile_version=108,
                      data_size=0,
                      data_type='.FIT'):
-        self.buf.seek(0)
+        if self._start is not None:
+            self.buf.seek(self._start)
         s = pack('BBHI4s'.encode('ascii'), header_size, protocol_version, profile_version, data_size, data_type.encode('ascii'))
         self.buf.write(s)
+        self._header = s
 
-    def _build_content_block(self, content):
-        field_defs = []
-        values = []
-        for num, basetype, value, scale in content:
-            s = pack('BBB', num, basetype['size'], basetype['field'])
-            field_defs.append(s)
-            if value is None:
-                # invalid value
-                value = basetype['invalid']
-            elif scale is not None:
-                value *= scale
-            values.append(FitBaseType.pack(basetype, value))
-        return (b''.join(field_defs), b''.join(values))
-
-    def write_file_info(self, serial_number=None, time_created=None, manufacturer=None, product=None, number=None):
-        if time_created is None:
-            time_created = datetime.now()
-
-        content = [
-            (3, FitBaseType.uint32z, serial_number, None),
-            (4, FitBaseType.uint32, self.timestamp(time_created), None),
-            (1, FitBaseType.uint16, manufacturer, None),
-            (2, FitBaseType.uint16, product, None),
-            (5, FitBaseType.uint16, number, None),
-            (0, FitBaseType.enum, self.FILE_TYPE, None), # type
-        ]
-        fields, values = self._build_content_block(content)
-
-        # create fixed content
-        msg_number = self.GMSG_NUMS['file_id']
-        fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-
-        self.buf.write(b''.join([
-            # definition
-            self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_FILE_INFO),
-            fixed_content,
-            fields,
-            #record
-            self.record_header(lmsg_type=self.LMSG_TYPE_FILE_INFO),
-            values,
-        ]))
+    def _write(self, data):
+        self.buf.write(data)
+        self._crc = _calcCRC(self._crc, data)
+        self._data_size += len(data)
 
+    def timestamp(self, t):
+        """the timestamp in fit protocol is seconds since
+        UTC 00:00 Dec 31 1989 (631065600)"""
+        if isinstance(t, datetime):
+            t = time.mktime(t.timetuple())
+        return t - 631065600
 
-    def write_file_creator(self, software_version=None, hardware_version=None):
-        content = [
-            (0, FitBaseType.uint16, software_version, None),
-            (1, FitBaseType.uint8, hardware_version, None),
-        ]
-        fields, values = self._build_content_block(content)
-
-        msg_number = self.GMSG_NUMS['file_creator']
-        fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-        self.buf.write(b''.join([
-            # definition
-            self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_FILE_CREATOR),
-            fixed_content,
-            fields,
-            #record
-            self.record_header(lmsg_type=self.LMSG_TYPE_FILE_CREATOR),
-            values,
-        ]))
-
-    def write_device_info(self, timestamp, serial_number=None, cum_operationg_time=None, manufacturer=None,
-                          product=None, software_version=None, battery_voltage=None, device_index=None,
-                          device_type=None, hardware_version=None, battery_status=None):
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (3, FitBaseType.uint32z, serial_number, 1),
-            (7, FitBaseType.uint32, cum_operationg_time, 1),
-            (8, FitBaseType.uint32, None, None),  # unknown field(undocumented)
-            (2, FitBaseType.uint16, manufacturer, 1),
-            (4, FitBaseType.uint16, product, 1),
-            (5, FitBaseType.uint16, software_version, 100),
-            (10, FitBaseType.uint16, battery_voltage, 256),
-            (0, FitBaseType.uint8, device_index, 1),
-            (1, FitBaseType.uint8, device_type, 1),
-            (6, FitBaseType.uint8, hardware_version, 1),
-            (11, FitBaseType.uint8, battery_status, None),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.device_info_defined:
-            header = self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_DEVICE_INFO)
-            msg_number = self.GMSG_NUMS['device_info']
-            fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.device_info_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_DEVICE_INFO)
-        self.buf.write(header + values)
-
-    def write_weight_scale(self, timestamp, weight, percent_fat=None, percent_hydration=None,
-                           visceral_fat_mass=None, bone_mass=None, muscle_mass=None, basal_met=None,
-                           active_met=None, physique_rating=None, metabolic_age=None, visceral_fat_rating=None,
-                           bmi=None):
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (0, FitBaseType.uint16, weight, 100),
-            (1, FitBaseType.uint16, percent_fat, 100),
-            (2, FitBaseType.uint16, percent_hydration, 100),
-            (3, FitBaseType.uint16, visceral_fat_mass, 100),
-            (4, FitBaseType.uint16, bone_mass, 100),
-            (5, FitBaseType.uint16, muscle_mass, 100),
-            (7, FitBaseType.uint16, basal_met, 4),
-            (9, FitBaseType.uint16, active_met, 4),
-            (8, FitBaseType.uint8, physique_rating, 1),
-            (10, FitBaseType.uint8, metabolic_age, 1),
-            (11, FitBaseType.uint8, visceral_fat_rating, 1),
-            (13, FitBaseType.uint16, bmi, 10),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.weight_scale_defined:
-            header = self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE)
-            msg_number = self.GMSG_NUMS['weight_scale']
-            fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.weight_scale_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE)
-        self.buf.write(header + values)
+    def timestamps(self, column):
+        """timestamp() over a column of unix timestamps"""
+        if numpy is not None:
+            return numpy.asarray(column, dtype=numpy.float64) - 631065600
+        return [self.timestamp(t) for t in column]
+
+    @classmethod
+    def compile(cls, name, lmsg_type, fields=None):
+        """compiled definition of the profile message name, restricted to the
+        given field names if any. Compiled once and cached."""
+        key = (name, lmsg_type)
+        msg = cls._definitions.get(key)
+        if msg is None:
+            gmsg_num, profile = cls.PROFILE[name]
+            msg = cls._definitions[key] = FitMessageDefinition(gmsg_num, lmsg_type, profile)
+        if fields is not None:
+            msg = msg.select(fields)
+        return msg
+
+    def local_type(self, name):
+        lmsg_type = self._local_types.get(name)
+        if lmsg_type is None:
+            used = set(self._local_types.values())
+            free = [t for t in range(16) if t not in used]
+            if not free:
+                raise ValueError("no local message type left for %s" % name)
+            lmsg_type = self._local_types[name] = free[0]
+        return lmsg_type
+
+    def _define(self, name, fields=None):
+        """compiled definition for name, the definition message is written
+        when the local type is not yet defined with these fields"""
+        msg = self.compile(name, self.local_type(name), fields)
+        if self._defined.get(msg.lmsg_type) is not msg:
+            self._write(msg.definition)
+            self._defined[msg.lmsg_type] = msg
+        return msg
+
+    def write_message(self, name, fields=None, **values):
+        """write one record of the profile message name, fields limits the
+        definition to the named fields (all fields by default)"""
+        msg = self._define(name, fields)
+        record = self._records.get(msg)
+        if record is None:
+            record = self._records[msg] = bytearray(msg.size)
+        msg.pack_into(record, *[values.get(field) for field in msg.names])
+        # the buffer is overwritten by the next record, sinks may keep what
+        # they are given
+        self._write(bytes(record))
+
+    def write_message_batch(self, name, count, fields=None, **columns):
+        """write count records of the profile message name from columns,
+        see FitMessageDefinition.pack_columns"""
+        if not count:
+            return
+        msg = self._define(name, fields)
+        self._write(msg.pack_columns([columns.get(field) for field in msg.names], count))
 
     def record_header(self, definition=False, lmsg_type=0):
         msg = 0
@@ -240,33 +448,305 @@ class FitEncoder_Weight(FitEncoder):
         return pack('B', msg + lmsg_type)
 
     def crc(self):
-        orig_pos = self.buf.tell()
-        self.buf.seek(0)
-
-        crc = 0
-        while(True):
-            b = self.buf.read(1)
-            if not b:
-                break
-            crc = _calcCRC(crc, unpack('b', b)[0])
-        self.buf.seek(orig_pos)
+        """crc of the whole file, combined from the header and the running
+        crc of the records so nothing has to be read back"""
+        crc = _combineCRC(_calcCRC(0, self._header), self._crc, self._data_size)
         return pack('H', crc)
 
     def finish(self):
-        """re-weite file-header, then append crc to end of file"""
-        data_size = self.get_size() - self.HEADER_SIZE
-        self.write_header(data_size=data_size)
-        crc = self.crc()
-        self.buf.seek(0, 2)
-        self.buf.write(crc)
+        """re-weite file-header (unless it was written with the final size
+        upfront), then append crc to end of file"""
+        if self._declared_size is None:
+            self.write_header(data_size=self._data_size)
+            self.buf.seek(0, 2)
+        elif self._declared_size != self._data_size:
+            raise ValueError("declared data size %d does not match the %d bytes written"
+                             % (self._declared_size, self._data_size))
+        self.buf.write(self.crc())
+        self._finished = True
 
     def get_size(self):
-        orig_pos = self.buf.tell()
-        self.buf.seek(0, 2)
-        size = self.buf.tell()
-        self.buf.seek(orig_pos)
-        return size
+        return self.HEADER_SIZE + self._data_size + (2 if self._finished else 0)
 
     def getvalue(self):
         return self.buf.getvalue()
 
+
+class FitEncoder_File(FitEncoder):
+    """a file of FILE_TYPE with the file_id, file_creator and device_info
+    records Garmin Connect expects"""
+    FILE_TYPE = None
+    LMSG_TYPE_FILE_INFO = 0
+    LMSG_TYPE_FILE_CREATOR = 1
+    LMSG_TYPE_DEVICE_INFO = 2
+    LMSG_TYPE_WEIGHT_SCALE = 3
+    LMSG_TYPE_BLOOD_PRESSURE = 4
+
+    LOCAL_TYPES = {
+        'file_id': LMSG_TYPE_FILE_INFO,
+        'file_creator': LMSG_TYPE_FILE_CREATOR,
+        'device_info': LMSG_TYPE_DEVICE_INFO,
+        'weight_scale': LMSG_TYPE_WEIGHT_SCALE,
+        'blood_pressure': LMSG_TYPE_BLOOD_PRESSURE,
+    }
+
+    def write_file_info(self, serial_number=None, time_created=None, manufacturer=None, product=None, number=None):
+        if time_created is None:
+            time_created = datetime.now()
+
+        self.write_message('file_id', serial_number=serial_number, time_created=self.timestamp(time_created),
+                           manufacturer=manufacturer, product=product, number=number, type=self.FILE_TYPE)
+
+    def write_file_creator(self, software_version=None, hardware_version=None):
+        self.write_message('file_creator', software_version=software_version, hardware_version=hardware_version)
+
+    def write_device_info(self, timestamp, serial_number=None, cum_operationg_time=None, manufacturer=None,
+                          product=None, software_version=None, battery_voltage=None, device_index=None,
+                          device_type=None, hardware_version=None, battery_status=None):
+        self.write_message('device_info', timestamp=self.timestamp(timestamp), serial_number=serial_number,
+                           cum_operating_time=cum_operationg_time, manufacturer=manufacturer, product=product,
+                           software_version=software_version, battery_voltage=battery_voltage,
+                           device_index=device_index, device_type=device_type,
+                           hardware_version=hardware_version, battery_status=battery_status)
+
+    @classmethod
+    def _expected_data_size(cls, messages):
+        """data size of a file with one file_id and file_creator record and
+        the (message name, record count, fields) messages, each written in
+        one batch"""
+        size = 0
+        for name, count, fields in [('file_id', 1, None), ('file_creator', 1, None)] + list(messages):
+            if count:
+                msg = cls.compile(name, cls.LOCAL_TYPES[name], fields)
+                size += len(msg.definition) + count * msg.size
+        return size
+
+
+class FitEncoder_Weight(FitEncoder_File):
+    FILE_TYPE = 9
+
+    # always defined, even without a value
+    WEIGHT_SCALE_REQUIRED = ('timestamp', 'weight')
+
+    def write_weight_scale(self, timestamp, weight, **values):
+        """write a weight_scale record, only fields that carry a value are
+        defined. Optional fields are named as in Fit.PROFILE['weight_scale'].
+
+        The current definition is kept as long as it covers the fields of the
+        record (absent ones are written invalid), so fields that come and go
+        do not redefine the message for every record."""
+        values['timestamp'] = self.timestamp(timestamp)
+        values['weight'] = weight
+        fields = set(name for name, value in values.items()
+                     if value is not None or name in self.WEIGHT_SCALE_REQUIRED)
+        defined = self._defined.get(self.local_type('weight_scale'))
+        if defined is not None:
+            fields.update(defined.names)
+        self.write_message('weight_scale', fields=fields, **values)
+
+    def write_weight_scale_batch(self, timestamp, weight, **columns):
+        """write many weight_scale records in one go
+
+        Every argument is a column (list or numpy array) of equal length,
+        timestamp holds unix timestamps. Missing values are None (or NaN),
+        a column left as None is invalid for all records. Only columns with
+        at least one value are defined."""
+        count = len(timestamp)
+        columns['timestamp'] = self.timestamps(timestamp)
+        columns['weight'] = weight
+        fields = [name for name, column in columns.items()
+                  if name in self.WEIGHT_SCALE_REQUIRED or _populated(column)]
+        self.write_message_batch('weight_scale', count, fields=fields, **columns)
+
+    @classmethod
+    def expected_data_size(cls, weight_scale_records, device_info_records=1, weight_scale_fields=None):
+        """data size of a file with one file_info and file_creator record and
+        the given number of device_info and weight_scale records, written in
+        one batch. weight_scale_fields names the populated optional fields
+        (e.g. ('percent_fat', 'bmi')), all fields when None."""
+        if weight_scale_fields is not None:
+            weight_scale_fields = tuple(weight_scale_fields) + cls.WEIGHT_SCALE_REQUIRED
+        return cls._expected_data_size([('device_info', device_info_records, None),
+                                        ('weight_scale', weight_scale_records, weight_scale_fields)])
+
+
+class FitEncoder_BloodPressure(FitEncoder_File):
+    """blood_pressure messages belong in a file of their own type"""
+    FILE_TYPE = 14
+
+    # always defined, even without a value
+    BLOOD_PRESSURE_REQUIRED = ('timestamp', 'systolic_pressure', 'diastolic_pressure')
+
+    def write_blood_pressure_batch(self, timestamp, systolic_pressure, diastolic_pressure, **columns):
+        """write many blood_pressure records (pressures in mmHg, heart_rate
+        in bpm) in one go, columns as in
+        FitEncoder_Weight.write_weight_scale_batch"""
+        count = len(timestamp)
+        columns['timestamp'] = self.timestamps(timestamp)
+        columns['systolic_pressure'] = systolic_pressure
+        columns['diastolic_pressure'] = diastolic_pressure
+        fields = [name for name, column in columns.items()
+                  if name in self.BLOOD_PRESSURE_REQUIRED or _populated(column)]
+        self.write_message_batch('blood_pressure', count, fields=fields, **columns)
+
+    @classmethod
+    def expected_data_size(cls, blood_pressure_records, device_info_records=1, blood_pressure_fields=None):
+        """data size of a file with one file_info and file_creator record and
+        the given number of device_info and blood_pressure records, written in
+        one batch. blood_pressure_fields names the populated optional fields
+        (e.g. ('heart_rate',)), all fields when None."""
+        if blood_pressure_fields is not None:
+            blood_pressure_fields = tuple(blood_pressure_fields) + cls.BLOOD_PRESSURE_REQUIRED
+        return cls._expected_data_size([('device_info', device_info_records, None),
+                                        ('blood_pressure', blood_pressure_records, blood_pressure_fields)])
+
+
+FitRecord = namedtuple('FitRecord', ['gmsg_num', 'lmsg_type', 'fields'])
+
+
+class FitDecoder(Fit):
+    """Decoder for FIT files
+
+    data is any bytes-like object (bytes, bytearray, mmap), records are
+    streamed from it without copying. Field values are returned raw (not
+    scaled) by field number, invalid values as None."""
+    BASETYPES = dict((basetype['field'], basetype) for basetype in (
+        FitBaseType.enum, FitBaseType.sint8, FitBaseType.uint8, FitBaseType.sint16, FitBaseType.uint16,
+        FitBaseType.sint32, FitBaseType.uint32, FitBaseType.string, FitBaseType.float32,
+        FitBaseType.float64, FitBaseType.uint8z, FitBaseType.uint16z, FitBaseType.uint32z, FitBaseType.byte))
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self._mmap = None
+
+    @classmethod
+    def open(cls, path):
+        """decoder reading a file through a read-only memory map"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'')
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        decoder = cls(m)
+        decoder._mmap = m
+        return decoder
+
+    def close(self):
+        self.data.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def header(self):
+        """(header_size, protocol_version, profile_version, data_size, data_type)"""
+        if len(self.data) < self.HEADER_SIZE:
+            raise ValueError("file too short for a FIT header (%d bytes)" % len(self.data))
+        header_size, protocol_version, profile_version, data_size, data_type = unpack_from('<BBHI4s', self.data)
+        return header_size, protocol_version, profile_version, data_size, data_type
+
+    def verify(self):
+        """check the header, data size and file CRC, raises ValueError
+        describing the first problem found"""
+        header_size, _, _, data_size, data_type = self.header()
+        if data_type != b'.FIT':
+            raise ValueError("not a FIT file (data type %r)" % data_type)
+        if header_size not in (12, 14) or header_size > len(self.data):
+            raise ValueError("invalid header size %d" % header_size)
+        if header_size == 14:
+            header_crc, = unpack_from('<H', self.data, 12)
+            if header_crc and header_crc != _calcCRC(0, self.data[:12]):
+                raise ValueError("header CRC mismatch")
+        if header_size + data_size + 2 != len(self.data):
+            raise ValueError("data size %d does not match file size %d" % (data_size, len(self.data)))
+        if _calcCRC(0, self.data) != 0:
+            raise ValueError("file CRC mismatch")
+        return True
+
+    @staticmethod
+    def _check(pos, size, end, what):
+        """raise ValueError when the size bytes of what at pos go past end"""
+        if pos + size > end:
+            raise ValueError("truncated %s at %d (%d bytes needed, %d left)" % (what, pos, size, max(end - pos, 0)))
+
+    def _compile(self, pos, header, end):
+        """parse the definition message at pos (up to end), returns the
+        compiled definition and the position of the next message"""
+        self._check(pos, 5, end, 'definition message')
+        architecture = self.data[pos + 1]
+        endian = '>' if architecture else '<'
+        gmsg_num, num_fields = unpack_from(endian + 'HB', self.data, pos + 2)
+        pos += 5
+        self._check(pos, 3 * num_fields, end, 'field definitions')
+        formats = []
+        fields = []
+        for i in range(num_fields):
+            num, size, base = self.data[pos], self.data[pos + 1], self.data[pos + 2]
+            pos += 3
+            basetype = self.BASETYPES.get(base)
+            fmt = FitBaseType.get_format(basetype) if basetype else None
+            if fmt is None or fmt in 'sc' or calcsize(fmt) != size:
+                # strings, arrays and unknown types are returned as bytes
+                formats.append('%ds' % size)
+                fields.append((num, None))
+            else:
+                formats.append(fmt)
+                fields.append((num, basetype['invalid']))
+        if header & 0x20:
+            # developer data fields are skipped
+            self._check(pos, 1, end, 'developer field count')
+            num_dev_fields = self.data[pos]
+            pos += 1
+            self._check(pos, 3 * num_dev_fields, end, 'developer field definitions')
+            formats.append('%dx' % sum(self.data[pos + 3 * i + 1] for i in range(num_dev_fields)))
+            pos += 3 * num_dev_fields
+        return (gmsg_num, Struct(endian + ''.join(formats)), tuple(fields)), pos
+
+    def records(self):
+        """generator over the data messages as FitRecord tuples, timestamps
+        of compressed timestamp headers are expanded into field 253. Raises
+        ValueError on truncated or corrupt data."""
+        header_size, _, _, data_size, _ = self.header()
+        data = self.data
+        pos = header_size
+        end = min(header_size + data_size, len(data))
+        definitions = {}
+        last_timestamp = None
+        while pos < end:
+            header = data[pos]
+            pos += 1
+            timestamp = None
+            if header & 0x80:
+                # compressed timestamp header
+                lmsg_type = (header >> 5) & 0x3
+                if last_timestamp is None:
+                    raise ValueError("compressed timestamp without reference timestamp at %d" % (pos - 1))
+                offset = header & 0x1F
+                timestamp = (last_timestamp & 0xFFFFFFE0) + offset
+                if offset < last_timestamp & 0x1F:
+                    timestamp += 0x20
+                last_timestamp = timestamp
+            elif header & 0x40:
+                definitions[header & 0x0F], pos = self._compile(pos, header, end)
+                continue
+            else:
+                lmsg_type = header & 0x0F
+
+            try:
+                gmsg_num, struct, fields = definitions[lmsg_type]
+            except KeyError:
+                raise ValueError("data message for undefined local message %d at %d" % (lmsg_type, pos - 1))
+            self._check(pos, struct.size, end, 'data message')
+            values = {}
+            for (num, invalid), value in zip(fields, struct.unpack_from(data, pos)):
+                values[num] = None if value == invalid else value
+            pos += struct.size
+            if timestamp is not None:
+                values[253] = timestamp
+            elif values.get(253) is not None:
+                last_timestamp = values[253]
+            yield FitRecord(gmsg_num, lmsg_type, values)
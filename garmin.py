@@ -8,6 +8,18 @@ import requests
 import re
 import sys
 import json
+import uuid
+import os
+import time
+import base64
+import hashlib
+import tempfile
+import zipfile
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = InvalidToken = None
 
 # {{{
 # Exception definitions used below from tapiriik/tapiriik/services/api.py
@@ -106,11 +118,114 @@ class LoginFailed(Exception):
 # }}}
 
 
+class _MultipartFileBody(object):
+    """multipart/form-data request body streaming a single file field
+
+    Sent with a Content-Length when the file can seek, chunked otherwise."""
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, name, filename, f):
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % boundary
+        self._head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name, filename)).encode('ascii')
+        self._tail = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+        self._file = f
+        # not every file-like object has seekable() (SpooledTemporaryFile
+        # before Python 3.11), so try to seek
+        try:
+            pos = f.tell()
+            f.seek(0, 2)
+            size = f.tell() - pos
+            f.seek(pos)
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+        else:
+            # picked up by requests to send a Content-Length
+            self.len = len(self._head) + size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        while True:
+            chunk = self._file.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield self._tail
+
+
+class _SessionFile(object):
+    """Session cookies saved encrypted in a file, with a key derived from the
+    account password, so a login survives the process"""
+    KDF_ITERATIONS = 200000
+
+    def __init__(self, path, lifetime):
+        self.path = path
+        self.lifetime = lifetime
+
+    @classmethod
+    def available(cls):
+        return Fernet is not None
+
+    def _fernet(self, password, salt):
+        key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, self.KDF_ITERATIONS, 32)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def load(self, username, password):
+        """the saved cookies as a list of dicts, None when missing, expired,
+        saved for another account or undecryptable"""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            salt = base64.b64decode(saved['salt'])
+            data = json.loads(self._fernet(password, salt).decrypt(saved['token'].encode('ascii')).decode('utf-8'))
+        except (IOError, ValueError, KeyError, TypeError, InvalidToken):
+            return None
+        if data.get('username') != username or data.get('expires', 0) <= time.time():
+            return None
+        return data['cookies']
+
+    def save(self, username, password, cookies):
+        salt = os.urandom(16)
+        data = {
+            'username': username,
+            'expires': time.time() + self.lifetime.total_seconds(),
+            'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+                         'expires': c.expires, 'secure': c.secure} for c in cookies],
+        }
+        token = self._fernet(password, salt).encrypt(json.dumps(data).encode('utf-8'))
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'salt': base64.b64encode(salt).decode('ascii'), 'token': token.decode('ascii')}, f)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
 class GarminConnect(object):
     LOGIN_URL = 'https://connect.garmin.com/signin'
+    PROFILE_URL = 'https://connect.garmin.com/modern'
     UPLOAD_URL = 'https://connect.garmin.com/modern/proxy/upload-service/upload/.fit'
+    ZIP_UPLOAD_URL = 'https://connect.garmin.com/modern/proxy/upload-service/upload/.zip'
+    WEIGHT_URL = 'https://connect.garmin.com/modern/proxy/weight-service/weight/dateRange'
     
-    _sessionCache = SessionCache(lifetime=timedelta(minutes=30), freshen_on_get=True)
+    _sessionCache = SessionCache(lifetime=timedelta(minutes=30), freshen_on_get=True, max_size=1000)
+
+    # how long cookies saved to the session file are tried before a new login
+    SESSION_FILE_LIFETIME = timedelta(hours=12)
+
+    def __init__(self, session_file=None):
+        """session_file keeps the session cookies between runs (encrypted,
+        requires the cryptography package)"""
+        self._sessionFile = None
+        if session_file:
+            if _SessionFile.available():
+                self._sessionFile = _SessionFile(session_file, self.SESSION_FILE_LIFETIME)
+            else:
+                sys.stderr.write('Install cryptography to keep the Garmin Connect session between runs\n')
     
     def create_opener(self, cookie):
         this = self
@@ -222,15 +337,39 @@ class GarminConnect(object):
             for key, value in cookies.items():
                 print("Key: " + key + ", " + value)
 
+    def _get_username(self, session):
+        res = session.get(self.PROFILE_URL)
+        userdata_json_str = re.search(r"VIEWER_SOCIAL_PROFILE\s*=\s*JSON\.parse\((.+)\);$", res.text, re.MULTILINE).group(1)
+        userdata = json.loads(json.loads(userdata_json_str))
+        return userdata["displayName"]
+
+    def _resume_session(self, username, password):
+        """a session with the saved cookies if they still work, None otherwise"""
+        cookies = self._sessionFile.load(username, password)
+        if not cookies:
+            return None
+        session = requests.Session()
+        for cookie in cookies:
+            session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'],
+                                expires=cookie['expires'], secure=cookie['secure'])
+        try:
+            GCusername = self._get_username(session)
+        except Exception:
+            self._sessionFile.remove()
+            return None
+        sys.stderr.write('Garmin Connect User Name: ' + GCusername + ' (saved session)\n')
+        return session
+
     def login(self, username, password):
 
+        if self._sessionFile:
+            session = self._resume_session(username, password)
+            if session:
+                return session
+
         session = self._get_session(email=username, password=password)
         try:
-            res = session.get("https://connect.garmin.com/modern")
-            
-            userdata_json_str = re.search(r"VIEWER_SOCIAL_PROFILE\s*=\s*JSON\.parse\((.+)\);$", res.text, re.MULTILINE).group(1)
-            userdata = json.loads(json.loads(userdata_json_str))
-            GCusername = userdata["displayName"]
+            GCusername = self._get_username(session)
         except Exception as e:
             raise APIException("Unable to retrieve username: %s" % e, block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
             
@@ -238,15 +377,51 @@ class GarminConnect(object):
         
         if not len(GCusername):
             raise APIException("Unable to retrieve username", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
-        return (session)
-
-    def upload_file(self, f, session):
-        files = {"data": ("withings.fit", f)}
 
-        res = session.post(self.UPLOAD_URL,
-                           files=files,
-                           headers={"nk": "NT"}) 
+        if self._sessionFile:
+            self._sessionFile.save(username, password, session.cookies)
+        return (session)
 
+    def get_weigh_ins(self, session, start, end):
+        """timestamps (epoch seconds) of the weigh-ins in Garmin Connect from
+        start to end, with a single query for the whole range"""
+        # the range is in calendar days of the account's time zone, a day
+        # more on both sides covers any offset
+        day = 24 * 3600
+        params = {
+            "startDate": datetime.datetime.fromtimestamp(start - day, datetime.timezone.utc).strftime("%Y-%m-%d"),
+            "endDate": datetime.datetime.fromtimestamp(end + day, datetime.timezone.utc).strftime("%Y-%m-%d"),
+        }
+        res = session.get(self.WEIGHT_URL, params=params, headers={"nk": "NT"})
+        if res.status_code != 200:
+            raise APIException("Bad response during GC weight query: %s %s" % (res.status_code, res.text))
+
+        # timestampGMT is in epoch milliseconds, "date" is in the account's
+        # local time and cannot be compared with measurement timestamps
+        timestamps = set()
+        for entry in res.json().get("dateWeightList") or []:
+            t = entry.get("timestampGMT")
+            if t is not None:
+                timestamps.add(int(t) // 1000)
+        return timestamps
+
+    def upload(self, f, session, filename="withings.fit", url=None):
+        """upload a FIT file, given as bytes or as a file-like object which is
+        streamed from its current position without being read into memory,
+        returns an UploadResult"""
+        url = url or self.UPLOAD_URL
+        if hasattr(f, 'read'):
+            body = _MultipartFileBody("data", filename, f)
+            res = session.post(url,
+                               data=body,
+                               headers={"nk": "NT", "Content-Type": body.content_type})
+        else:
+            files = {"data": (filename, f)}
+            res = session.post(url,
+                               files=files,
+                               headers={"nk": "NT"})
+
+        resp = {}
         try:
             resp = res.json()["detailedImportResult"]
         except ValueError:
@@ -256,5 +431,89 @@ class GarminConnect(object):
                 print("Bad response during GC upload: " + str(res.status_code))
                 raise APIException("Bad response during GC upload: %s %s" % (res.status_code, res.text))
 
-        return (res.status_code == 200 or res.status_code == 201 or res.status_code == 204)
+        return UploadResult(res.status_code, resp)
+
+    def upload_files(self, files, session):
+        """upload several FIT files, (filename, bytes or file-like object)
+        pairs, in a single zip archive, returns an UploadResult per filename"""
+        archive = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+            for filename, f in files:
+                if hasattr(f, 'read'):
+                    with z.open(filename, "w") as member:
+                        while True:
+                            chunk = f.read(_MultipartFileBody.CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            member.write(chunk)
+                else:
+                    z.writestr(filename, f)
+        archive.seek(0)
+        try:
+            result = self.upload(archive, session, filename="withings.zip", url=self.ZIP_UPLOAD_URL)
+        finally:
+            archive.close()
+        return result.split([filename for filename, _ in files])
 
+    def upload_file(self, f, session):
+        """upload a FIT file, see upload(), returns whether it was accepted"""
+        return self.upload(f, session).accepted
+
+
+class UploadResult(object):
+    """Outcome of an upload, from the detailedImportResult of the response"""
+    # failure message code of a file that was imported before
+    DUPLICATE = 202
+
+    def __init__(self, status_code, result=None):
+        result = result or {}
+        self.status_code = status_code
+        self.upload_id = result.get("uploadId")
+        self.successes = result.get("successes") or []
+        self.failures = result.get("failures") or []
+        # set by split() when a failure does not name its file
+        self.unmatched = False
+
+    @property
+    def accepted(self):
+        """the upload request went through (files may still have failed)"""
+        return self.status_code in (200, 201, 202, 204)
+
+    @property
+    def duplicates(self):
+        return [failure for failure in self.failures if self._is_duplicate(failure)]
+
+    def _is_duplicate(self, failure):
+        return any(message.get("code") == self.DUPLICATE for message in failure.get("messages") or [])
+
+    @property
+    def pending(self):
+        """accepted (202) with no import result yet, the files may still fail"""
+        return self.status_code == 202 and not self.successes and not self.failures
+
+    @property
+    def ok(self):
+        """accepted and every file imported, or already present"""
+        return self.accepted and not self.pending and len(self.duplicates) == len(self.failures)
+
+    def split(self, filenames):
+        """an UploadResult for each file of a zip upload. Entries that do not
+        name their file count for every file, the results then have unmatched
+        set when such a failure is not a duplicate, since any of the files
+        may be the one that failed"""
+        def named(entries, filename):
+            return [entry for entry in entries if entry.get("fileName") in (filename, None)]
+        unmatched = any(failure.get("fileName") is None and not self._is_duplicate(failure)
+                        for failure in self.failures)
+        results = {}
+        for filename in filenames:
+            result = UploadResult(self.status_code)
+            result.upload_id = self.upload_id
+            result.successes = named(self.successes, filename)
+            result.failures = named(self.failures, filename)
+            result.unmatched = unmatched
+            results[filename] = result
+        return results
+
+    def __repr__(self):
+        return "UploadResult(%s, %d successes, %d failures)" % (self.status_code, len(self.successes), len(self.failures))
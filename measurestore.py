@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Local store of Nokia Health measurements
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measure groups are kept in a SQLite database keyed by grpid and fed
+incrementally with getmeas lastupdate=, so reading measurements back needs no
+request to the Nokia Health API. Every group gets an increasing sequence
+number each time it is stored, and every destination service keeps its own
+cursor (the sequence number of the last group it received) into the store, so
+groups that reach Nokia Health late, or are changed later, are still sent.
+
+Usage:
+
+store = MeasureStore('measures.db')
+store.update(client)
+for seq, group in store.iter_changes(after=store.get_cursor('garmin')):
+    ...
+store.set_cursor('garmin', seq)
+
+"""
+
+import bisect
+import sqlite3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from nokia import NokiaMeasureGroup, ts
+
+
+class HeightSeries(object):
+    """Heights over time, to compute a BMI with the height measured at the
+    time of each weighing. Weighings before the first height use that one."""
+
+    def __init__(self, timestamps, heights):
+        self.timestamps = list(timestamps)
+        self.heights = list(heights)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def at(self, timestamp):
+        """the height in effect at timestamp, None without any height"""
+        if not self.timestamps:
+            return None
+        i = bisect.bisect_right(self.timestamps, timestamp) - 1
+        return self.heights[max(i, 0)]
+
+    def bmi(self, timestamps, weights):
+        """BMI for each weighing rounded to 0.1, None without any height"""
+        if not self.timestamps:
+            return None
+        if numpy is not None:
+            i = numpy.searchsorted(self.timestamps, timestamps, side='right') - 1
+            heights = numpy.asarray(self.heights, dtype=numpy.float64)[numpy.maximum(i, 0)]
+            return numpy.round(numpy.asarray(weights, dtype=numpy.float64) / (heights * heights), 1)
+        return [round(weight / (height * height), 1)
+                for weight, height in zip(weights, map(self.at, timestamps))]
+
+
+class MeasureStore(object):
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS groups (
+            grpid INTEGER PRIMARY KEY,
+            date INTEGER NOT NULL,
+            attrib INTEGER,
+            category INTEGER,
+            deviceid TEXT,
+            seq INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS measures (
+            grpid INTEGER NOT NULL REFERENCES groups (grpid) ON DELETE CASCADE,
+            type INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            unit INTEGER NOT NULL,
+            PRIMARY KEY (grpid, type)
+        );
+        CREATE INDEX IF NOT EXISTS groups_date ON groups (date);
+        CREATE INDEX IF NOT EXISTS measures_type ON measures (type, grpid);
+        CREATE TABLE IF NOT EXISTS cursors (
+            service TEXT PRIMARY KEY,
+            position INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS uploads (
+            service TEXT NOT NULL,
+            first INTEGER NOT NULL,
+            last INTEGER NOT NULL,
+            records INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            upload_id TEXT,
+            updated INTEGER NOT NULL,
+            PRIMARY KEY (service, first, last)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        );
+    '''
+
+    GROUP_COLUMNS = ('grpid', 'date', 'attrib', 'category', 'deviceid')
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(self.SCHEMA)
+        if 'seq' not in [row[1] for row in self.db.execute('PRAGMA table_info(groups)')]:
+            with self.db:
+                self._add_sequence()
+        self.db.execute('CREATE INDEX IF NOT EXISTS groups_seq ON groups (seq)')
+
+    def _add_sequence(self):
+        """number the groups of a store from before sequence numbers in date
+        order, and move the cursors and the upload ledger from dates to
+        sequence numbers"""
+        self.db.execute('ALTER TABLE groups ADD COLUMN seq INTEGER')
+        grpids = [row[0] for row in self.db.execute('SELECT grpid FROM groups ORDER BY date, grpid')]
+        self.db.executemany('UPDATE groups SET seq = ? WHERE grpid = ?',
+                            [(seq, grpid) for seq, grpid in enumerate(grpids, 1)])
+        self._set_meta('seq', len(grpids))
+        for service, position in self.db.execute('SELECT service, position FROM cursors').fetchall():
+            self.db.execute('UPDATE cursors SET position = ? WHERE service = ?', (self.seq_at(position), service))
+        for row in self.db.execute('SELECT service, first, last FROM uploads').fetchall():
+            first = self.db.execute('SELECT MIN(seq) FROM groups WHERE date >= ?', row[1:2]).fetchone()[0]
+            self.db.execute('UPDATE uploads SET first = ?, last = ? WHERE service = ? AND first = ? AND last = ?',
+                            (first or 0, self.seq_at(row[2])) + row)
+
+    def close(self):
+        self.db.close()
+
+    def _get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def get_lastupdate(self):
+        return self._get_meta('lastupdate', 0)
+
+    def update(self, client):
+        """Fetch the groups added or changed since the last update (the whole
+        history the first time) and store them, returns the number of groups
+        received"""
+        lastupdate = self.get_lastupdate()
+        started = ts()
+        if lastupdate:
+            pages = client.iter_measure_pages(keep_data=True, lastupdate=lastupdate)
+        else:
+            pages = client.iter_backfill_pages(keep_data=True)
+
+        count = 0
+        for page in pages:
+            with self.db:
+                self.add_groups(page)
+            count += len(page)
+
+        with self.db:
+            self._set_meta('lastupdate', started)
+        return count
+
+    def add_groups(self, groups):
+        """Insert or replace groups, which must have been built with
+        keep_data=True, each under the next sequence number"""
+        grpids = [(group.grpid,) for group in groups]
+        seq = self._get_meta('seq', 0)
+        self.db.executemany('DELETE FROM measures WHERE grpid = ?', grpids)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO groups (grpid, date, attrib, category, deviceid, seq) VALUES (?, ?, ?, ?, ?, ?)',
+            [(group.grpid, group.timestamp, group.data.get('attrib'), group.data.get('category'),
+              group.data.get('deviceid'), seq + i) for i, group in enumerate(groups, 1)])
+        self._set_meta('seq', seq + len(groups))
+        self.db.executemany(
+            'INSERT OR REPLACE INTO measures (grpid, type, value, unit) VALUES (?, ?, ?, ?)',
+            [(group.grpid, m['type'], m['value'], m['unit']) for group in groups for m in group.measures])
+
+    def _iter_query(self, where, params, order, limit=None):
+        """(sequence number, group) of the groups selected by the where
+        clause, rebuilt as NokiaMeasureGroup and sorted on the order columns"""
+        sql = 'SELECT %s, seq FROM groups' % ', '.join(self.GROUP_COLUMNS)
+        if where:
+            sql += ' WHERE ' + where
+        sql += ' ORDER BY ' + ', '.join(order)
+        if limit is not None:
+            sql += ' LIMIT %d' % int(limit)
+        sql = ('SELECT g.grpid, g.date, g.attrib, g.category, g.deviceid, g.seq, m.type, m.value, m.unit '
+               'FROM (%s) g LEFT JOIN measures m ON m.grpid = g.grpid '
+               'ORDER BY %s' % (sql, ', '.join('g.' + column for column in order)))
+
+        data = seq = None
+        for row in self.db.execute(sql, params):
+            if data is None or data['grpid'] != row[0]:
+                if data is not None:
+                    yield seq, NokiaMeasureGroup(data)
+                data = dict(zip(self.GROUP_COLUMNS, row[:5]))
+                data['measures'] = []
+                seq = row[5]
+            if row[6] is not None:
+                data['measures'].append({'type': row[6], 'value': row[7], 'unit': row[8]})
+        if data is not None:
+            yield seq, NokiaMeasureGroup(data)
+
+    def iter_groups(self, since=None, until=None):
+        """Groups dated after since (exclusive) and up to until, oldest first"""
+        where = []
+        params = []
+        if since is not None:
+            where.append('date > ?')
+            params.append(since)
+        if until is not None:
+            where.append('date <= ?')
+            params.append(until)
+        return (group for _, group in self._iter_query(' AND '.join(where), params, ('date', 'grpid')))
+
+    def iter_changes(self, after=0):
+        """(sequence number, group) of the groups stored or replaced after the
+        sequence number after, in the order they were stored"""
+        return self._iter_query('seq > ?', (after,), ('seq',))
+
+    def iter_change_pages(self, after=0, size=1000):
+        """iter_changes() in lists of at most size pairs"""
+        page = []
+        for change in self.iter_changes(after):
+            page.append(change)
+            if len(page) == size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def seq_at(self, date):
+        """The last sequence number up to which only groups dated up to date
+        were stored, to move a date cursor to a sequence number"""
+        row = self.db.execute('SELECT MIN(seq) FROM groups WHERE date > ?', (date,)).fetchone()
+        if row[0] is not None:
+            return row[0] - 1
+        return self._get_meta('seq', 0)
+
+    def last(self, n=1):
+        """The n most recent groups, newest first"""
+        return [group for _, group in self._iter_query(None, (), ('date DESC', 'grpid DESC'), limit=n)]
+
+    def height_series(self):
+        """All stored heights as a HeightSeries"""
+        height = dict(NokiaMeasureGroup.MEASURE_TYPES)['height']
+        rows = self.db.execute(
+            'SELECT g.date, m.value, m.unit FROM measures m JOIN groups g ON g.grpid = m.grpid '
+            'WHERE m.type = ? ORDER BY g.date, g.grpid', (height,)).fetchall()
+        return HeightSeries([row[0] for row in rows], [value * 10 ** unit for _, value, unit in rows])
+
+    def record_upload(self, service, first, last, records, status, upload_id=None):
+        """Keep the outcome of uploading the groups stored under the sequence
+        numbers first to last (inclusive) in the ledger, status is 'confirmed', 'pending' (accepted
+        but not imported yet) or 'failed'"""
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO uploads (service, first, last, records, status, upload_id, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (service, first, last, records, status, upload_id, ts()))
+
+    def confirmed_uploads(self, service, since=0):
+        """(first, last) sequence number ranges confirmed by the service after
+        since"""
+        return self.db.execute(
+            'SELECT first, last FROM uploads WHERE service = ? AND status = ? AND last > ? ORDER BY first',
+            (service, 'confirmed', since)).fetchall()
+
+    def get_cursor(self, service, default=0):
+        row = self.db.execute('SELECT position FROM cursors WHERE service = ?', (service,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_cursor(self, service, position):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO cursors (service, position) VALUES (?, ?)',
+                            (service, position))
@@ -9,14 +9,17 @@ __license__ = "GPLv3"
 
 from optparse import OptionParser
 import configparser
-from fit import FitEncoder_Weight
+from fit import FitEncoder_Weight, FitEncoder_BloodPressure
+from measurestore import MeasureStore
 from garmin import GarminConnect
 from smashrun import Smashrun
 from oauthlib.oauth2 import MobileApplicationClient
 import urllib.parse
+import collections
 import nokia
 import os.path
 import sys
+import tempfile
 import time
 import getpass
 import base64
@@ -44,7 +47,7 @@ class MyParser(OptionParser):
 usage = "usage: %prog [options] command [service]"
 epilog = """
 Commands:
-  setup, sync, last, userinfo, subscribe, unsubscribe, list_subscriptions
+  setup, update, sync, sync-preview, last, lastn, userinfo, subscribe, unsubscribe, list_subscriptions
 
 Services:
   nokia, garmin, smashrun, smashrun_code (setup only)
@@ -59,12 +62,17 @@ parser.add_option('-s', '--secret', dest='secret', help="Secret/Password")
 parser.add_option('-u', '--callback', dest='callback', help="Callback/redirect URI")
 parser.add_option('-a', '--authorization-server', dest='auth_serv', action="store_true", default=None, help="Authorization server")
 parser.add_option('-c', '--config', dest='config', default='config.ini', help="Config file")
+parser.add_option('-d', '--database', dest='database', default='measures.db', help="Local measurement store")
+parser.add_option('--cache', dest='cache', default='nokia-cache.json', help="Cache of Nokia Health user info and subscriptions")
+parser.add_option('--garmin-session', dest='garmin_session', default='garmin-session.json', help="Encrypted Garmin Connect session kept between runs")
+parser.add_option('--chunk-size', dest='chunk_size', type='int', default=1000, help="Measurement groups per FIT file uploaded to Garmin Connect")
+parser.add_option('--files-per-upload', dest='files_per_upload', type='int', default=10, help="FIT files zipped together in one Garmin Connect upload")
 
 (options, args) = parser.parse_args()
 
 if len(args) == 0:
     print("Missing command!")
-    print("Available commands: setup, sync, last, userinfo, subscribe, unsubscribe, list_subscriptions")
+    print("Available commands: setup, update, sync, sync-preview, last, lastn, userinfo, subscribe, unsubscribe, list_subscriptions")
     sys.exit(1)
 
 command = args.pop(0)
@@ -195,15 +203,39 @@ def setup_smashrun_code( options, config ):
 
     config.set('smashrun', 'client_id', options.key)
     config.set('smashrun', 'client_secret', options.secret)
-    config.set('smashrun', 'refresh_token', resp['refresh_token'])
     config.set('smashrun', 'type', 'code')
+    save_smashrun_token(resp)
+
+def save_smashrun_token( token ):
+    """ Keep a new Smashrun token, and the refresh token if it was rotated,
+    written to the config file right away since the old refresh token may
+    no longer be valid
+    """
+    if not config.has_section('smashrun'):
+        config.add_section('smashrun')
+    config.set('smashrun', 'access_token', token['access_token'])
+    config.set('smashrun', 'expires_at', str(int(token.get('expires_at', 0))))
+    if token.get('refresh_token'):
+        config.set('smashrun', 'refresh_token', token['refresh_token'])
+    write_config()
+
+def write_config():
+    """ Write the config file with the Garmin password encoded, replacing
+    the file at once so a crash cannot leave it half written
+    """
+    saved = configparser.RawConfigParser()
+    saved.read_dict(dict((section, dict(config.items(section, raw=True))) for section in config.sections()))
 
-def save_config():
     # Encode the Garmin password
-    if config.has_section('garmin'):
-        if config.has_option('garmin', 'password'):
-            config.set('garmin', 'password', base64.b64encode( config.get('garmin', 'password').encode('ascii') ).decode('ascii'))
+    if saved.has_option('garmin', 'password'):
+        saved.set('garmin', 'password', base64.b64encode( saved.get('garmin', 'password').encode('ascii') ).decode('ascii'))
+
+    tmp = options.config + '.tmp'
+    with open(tmp, 'w') as f:
+        saved.write(f)
+    os.replace(tmp, options.config)
 
+def save_config():
     # New Nokia tokens (if refreshed)
     if client_nokia:
         creds = client_nokia.get_credentials()
@@ -212,9 +244,7 @@ def save_config():
             config.set('nokia', 'token_expiry', creds.token_expiry)
             config.set('nokia', 'refresh_token', creds.refresh_token)
 
-    with open(options.config, 'w') as f:
-        config.write(f)
-        f.close()
+    write_config()
 
     print("Config file saved to %s" % options.config)
 
@@ -229,17 +259,30 @@ def auth_nokia( config ):
                                    config.get('nokia', 'consumer_key'),
                                    config.get('nokia', 'consumer_secret')
                                    )
-    client = nokia.NokiaApi(creds)
+    client = nokia.NokiaApi(creds, cache=nokia.FileResponseCache(options.cache))
     return client
 
+# seconds before expiry a saved Smashrun token is refreshed
+SMASHRUN_REFRESH_MARGIN = 300
+
 def auth_smashrun( config ):
     """ Authenticate client with Smashrun
     """
 
     if config.get('smashrun', 'type') == 'code':
+        token = None
+        if config.has_option('smashrun', 'access_token') and config.has_option('smashrun', 'expires_at'):
+            token = {'access_token': config.get('smashrun', 'access_token'),
+                     'refresh_token': config.get('smashrun', 'refresh_token'),
+                     'token_type': 'Bearer',
+                     'expires_at': int(config.get('smashrun', 'expires_at'))}
         client = Smashrun(client_id=config.get('smashrun', 'client_id'),
-                        client_secret=config.get('smashrun', 'client_secret'))
-        client.refresh_token(refresh_token=config.get('smashrun', 'refresh_token'))
+                        client_secret=config.get('smashrun', 'client_secret'),
+                        token=token, token_updater=save_smashrun_token)
+        # the saved token is used until it is about to expire, the session
+        # refreshes it by itself if that happens during the run
+        if token is None or token['expires_at'] - SMASHRUN_REFRESH_MARGIN <= time.time():
+            save_smashrun_token(client.refresh_token(refresh_token=config.get('smashrun', 'refresh_token')))
     else:
         mobile = MobileApplicationClient('client') # implicit flow
         client = Smashrun(client_id='client', client=mobile,
@@ -247,8 +290,77 @@ def auth_smashrun( config ):
     return client
 
 client_nokia = None
+store = None
 if command != 'setup':
     client_nokia = auth_nokia( config )
+    store = MeasureStore(options.database)
+
+def get_cursor( service ):
+    """ Position (sequence number) of a service in the measurement store,
+    taken over from the last_sync date of older config files
+    """
+    default = store.seq_at(int(config.get(service, 'last_sync'))) if config.has_option(service, 'last_sync') else 0
+    return store.get_cursor(service, default)
+
+def update_store():
+    """ Fetch new measurements from Nokia Health into the local store
+    """
+    count = store.update(client_nokia)
+    print("%d new or updated measurement groups from Nokia Health." % count)
+
+def encode_fit( groups, heights, present=() ):
+    """ Encode the weights and the blood pressures of the groups in FIT files
+    (one of each type), leaving out weights taken at the present timestamps,
+    returns the (kind, file) pairs to upload and the numbers of weights and
+    blood pressures. The files of the same groups are the same byte for byte,
+    so Garmin Connect takes a file uploaded again as a duplicate
+    """
+    types = dict(nokia.NokiaMeasureGroup.MEASURE_TYPES)
+
+    # groups come in the order they were stored, records go in time order
+    groups = sorted(groups, key=lambda m: m.timestamp)
+    weighings = [m for m in groups if m.get_measure(types['weight']) and m.timestamp not in present]
+    readings = [m for m in groups
+                if m.get_measure(types['systolic_blood_pressure']) and m.get_measure(types['diastolic_blood_pressure'])]
+
+    def encoder(cls):
+        # spooled to disk for large chunks
+        fit_file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        fit = cls(sink=fit_file)
+        fit.write_file_info(time_created=groups[-1].timestamp)
+        fit.write_file_creator()
+        return fit_file, fit
+
+    def finish(fit_file, fit):
+        fit.write_device_info(timestamp=groups[-1].timestamp)
+        fit.finish()
+        fit_file.seek(0)
+        return fit_file
+
+    files = []
+    if weighings:
+        # collect the weight groups column by column and encode them at once
+        fit_file, fit = encoder(FitEncoder_Weight)
+        timestamps = [m.timestamp for m in weighings]
+        weights = [m.get_measure(types['weight']) for m in weighings]
+        fit.write_weight_scale_batch(timestamp=timestamps, weight=weights,
+            percent_fat=[m.get_measure(types['fat_ratio']) for m in weighings],
+            percent_hydration=[m.get_measure(types['hydration']) for m in weighings],
+            bone_mass=[m.get_measure(types['bone_mass']) for m in weighings],
+            muscle_mass=[m.get_measure(types['muscle_mass']) for m in weighings],
+            bmi=heights.bmi(timestamps, weights))
+        files.append(('weight', finish(fit_file, fit)))
+
+    if readings:
+        # blood pressure (and heart rate) readings go in a blood pressure file
+        fit_file, fit = encoder(FitEncoder_BloodPressure)
+        fit.write_blood_pressure_batch(timestamp=[m.timestamp for m in readings],
+            systolic_pressure=[m.get_measure(types['systolic_blood_pressure']) for m in readings],
+            diastolic_pressure=[m.get_measure(types['diastolic_blood_pressure']) for m in readings],
+            heart_rate=[m.get_measure(types['heart_pulse']) for m in readings])
+        files.append(('blood-pressure', finish(fit_file, fit)))
+
+    return files, len(weighings), len(readings)
 
 if command == 'setup':
 
@@ -273,8 +385,15 @@ if command == 'setup':
 elif command == 'userinfo':
     print(client_nokia.get_user())
 
+elif command == 'update':
+    update_store()
+
 elif command == 'last':
-    m = client_nokia.get_measures(limit=1)[0]
+    groups = store.last(1)
+    if not groups:
+        print("No measurements stored yet, run the update command first.")
+        sys.exit(1)
+    m = groups[0]
 
     print(m.date)
     if len(args) == 1:
@@ -290,7 +409,7 @@ elif command == 'lastn':
         sys.exit(1)
 
     # Get n last measurements
-    mall = client_nokia.get_measures(limit=args[0])
+    mall = store.last(int(args[0]))
 
     for n, m in enumerate(mall):
         # Print clear header and date for each group
@@ -310,10 +429,9 @@ elif command == 'sync-preview':
         sys.exit(1)
 
     # Get next measurements
-    last_sync = int(config.get(service,'last_sync')) if config.has_option(service, 'last_sync') else 0
-    mall = client_nokia.get_measures(lastupdate=last_sync)
+    mall = store.iter_changes(after=get_cursor(service))
 
-    for n, m in enumerate(mall):
+    for n, (seq, m) in enumerate(mall):
         # Print clear header and date for each group
         print("--Group %i" % n)
         print(m.date)
@@ -332,81 +450,183 @@ elif command == 'sync':
         sys.exit(1)
 
     # Get next measurements
-    last_sync = int(config.get(service,'last_sync')) if config.has_option(service, 'last_sync') else 0
-    groups = client_nokia.get_measures(lastupdate=last_sync)
+    update_store()
+    last_sync = get_cursor(service)
     types = dict(nokia.NokiaMeasureGroup.MEASURE_TYPES)
 
-    if len(groups) == 0:
-        print("Their is no new measurement to sync.")
-        save_config()
-        sys.exit(0);
-
     if service == 'garmin':
 
-        next_sync = groups[-1].date.timestamp
-
-        # Do not repeatidly sync the same value
-        if next_sync == last_sync:
-            print('Last measurement was already synced')
+        # Heights over time for BMI calculation
+        heights = store.height_series()
+
+        # chunks confirmed by an earlier, interrupted run are not uploaded again
+        confirmed = store.confirmed_uploads('garmin', since=last_sync)
+
+        garmin = session = None
+        in_order = True
+        num_groups = num_weights = num_readings = num_failed = num_pending = 0
+
+        def login_garmin():
+            global garmin, session
+            if session is None:
+                garmin = GarminConnect(session_file=options.garmin_session)
+                session = garmin.login(config.get('garmin','username'), config.get('garmin','password'))
+
+        def upload_files(chunks):
+            """ Upload the FIT files of the chunks, zipped together when there
+            are several, returns the UploadResult of each file name
+            """
+            files = [(name, f) for chunk in chunks for name, f in chunk['files']]
+            if not files:
+                return {}
+            login_garmin()
+            for name, f in files:
+                f.seek(0)
+            try:
+                if len(files) == 1:
+                    return {files[0][0]: garmin.upload(files[0][1], session)}
+                return garmin.upload_files(files, session)
+            except Exception as e:
+                print("Upload of measurements from %s to %s failed: %s" % (chunks[0]['start'], chunks[-1]['end'], e))
+                return {}
+
+        def upload_chunks(chunks):
+            """ Upload the chunks together and record the outcome of each chunk
+            in order
+            """
+            global in_order, num_weights, num_readings, num_failed, num_pending
+            results = upload_files(chunks)
+            if len(chunks) > 1 and any(r.unmatched and not r.ok for r in results.values()):
+                # Garmin Connect did not say which file failed: upload the
+                # chunks one by one, files that went through already come
+                # back as duplicates
+                results = {}
+                for chunk in chunks:
+                    results.update(upload_files([chunk]))
+            for chunk in chunks:
+                for name, f in chunk['files']:
+                    f.close()
+
+            for chunk in chunks:
+                failed = [(name, results.get(name)) for name, _ in chunk['files']
+                          if results.get(name) is None or not results[name].ok]
+                if not failed:
+                    status = 'confirmed'
+                    num_weights += chunk['weights']
+                    num_readings += chunk['readings']
+                elif all(r is not None and r.pending for name, r in failed):
+                    # still being imported: uploaded again by the next sync,
+                    # where weigh-ins that made it in are skipped and files
+                    # imported meanwhile come back as duplicates since they
+                    # are encoded the same
+                    print("Measurements from %s to %s are still being imported by Garmin Connect." % (chunk['start'], chunk['end']))
+                    status = 'pending'
+                    num_pending += 1
+                else:
+                    for name, r in failed:
+                        if r is not None:
+                            print("Upload of %s failed: %s" % (name, r))
+                    status = 'failed'
+                    num_failed += 1
+                if chunk['files']:
+                    # the files of a chunk go in the same upload
+                    r = results.get(chunk['files'][0][0])
+                    store.record_upload('garmin', chunk['first'], chunk['last'], chunk['groups'], status,
+                                        r.upload_id if r is not None else None)
+
+                # resume after the last chunk with no failed chunk before it
+                if status == 'confirmed' and in_order:
+                    store.set_cursor('garmin', chunk['last'])
+                else:
+                    in_order = False
+
+        chunks = []
+        for changes in store.iter_change_pages(after=last_sync, size=options.chunk_size):
+            num_groups += len(changes)
+            first, last = changes[0][0], changes[-1][0]
+            start = min(m.timestamp for seq, m in changes)
+            end = max(m.timestamp for seq, m in changes)
+            groups = [m for seq, m in changes if not any(a <= seq <= b for a, b in confirmed)]
+
+            # weigh-ins Garmin Connect already has are not uploaded twice
+            present = set()
+            if any(m.get_measure(types['weight']) for m in groups):
+                login_garmin()
+                try:
+                    present = garmin.get_weigh_ins(session, start, end)
+                except Exception as e:
+                    print("Could not check the weigh-ins in Garmin Connect from %s to %s: %s" % (start, end, e))
+
+            files, weights, readings = encode_fit(groups, heights, present) if groups else ([], 0, 0)
+            chunks.append({'first': first, 'last': last, 'start': start, 'end': end,
+                           'groups': len(groups), 'weights': weights,
+                           'readings': readings,
+                           'files': [('withings-%d-%d-%s.fit' % (first, last, kind), f) for kind, f in files]})
+            if sum(len(chunk['files']) for chunk in chunks) >= options.files_per_upload:
+                upload_chunks(chunks)
+                chunks = []
+        upload_chunks(chunks)
+
+        if num_groups == 0:
+            print("Their is no new measurement to sync.")
             save_config()
             sys.exit(0)
 
-        # Get height for BMI calculation
-        height = None
-        m = client_nokia.get_measures(limit=1, meastype=types['height'])
-        if len(m):
-            height = m[0].get_measure(types['height'])
-
-        # create fit file
-        fit = FitEncoder_Weight()
-        fit.write_file_info()
-        fit.write_file_creator()
-        fit.write_device_info(timestamp=next_sync)
-        for m in groups:
-            weight = m.get_measure(types['weight']);
-            if weight:
-                bmi = None
-                if height:
-                    bmi = round(weight / pow(height, 2), 1)
-
-                fit.write_weight_scale(timestamp=m.date.timestamp, weight=weight, percent_fat=m.get_measure(types['fat_ratio']),
-                    percent_hydration=m.get_measure(types['hydration']), bone_mass=m.get_measure(types['bone_mass']), muscle_mass=m.get_measure(types['muscle_mass']),
-                    bmi=bmi)
-
-        fit.finish()
-
-        garmin = GarminConnect()
-        session = garmin.login(config.get('garmin','username'), config.get('garmin','password'))
-        r = garmin.upload_file(fit.getvalue(), session)
-        if r:
-            print("%d weights has been successfully updated to Garmin!" % (len(groups)))
-            config.set('garmin','last_sync', str(next_sync))
+        print("%d weights and %d blood pressures have been successfully updated to Garmin!" % (num_weights, num_readings))
+        if num_failed:
+            print("%d chunks failed and will be retried on the next sync." % num_failed)
+        if num_pending:
+            print("%d chunks are still being imported and will be checked on the next sync." % num_pending)
 
     elif service == 'smashrun':
 
-        for m in reversed(groups):
-            t = types['weight']
-            weight = m.get_measure(t)
+        # Smashrun keeps one weight per day, the last one taken that day
+        days = collections.OrderedDict()
+        changes = []
+        for seq, m in store.iter_changes(after=last_sync):
+            weight = m.get_measure(types['weight'])
+            day = None
             if weight:
-                break
-
-        print("Last weight from Nokia Health: %s kg taken at %s" % (weight, m.date))
+                day = m.date.format('YYYY-MM-DD')
+                if day not in days or days[day][1] <= m.timestamp:
+                    days[day] = (weight, m.timestamp)
+            changes.append((seq, day))
 
-
-        # Do not repeatidly sync the same value
-        if config.has_option('smashrun', 'last_sync'):
-            if m.date.timestamp == int(config.get('smashrun','last_sync')):
-                print('Last measurement was already synced')
-                save_config()
-                sys.exit(0)
+        if len(days) == 0:
+            print("Their is no new measurement to sync.")
+            save_config()
+            sys.exit(0)
 
         client_smashrun = auth_smashrun( config )
 
-        resp = client_smashrun.create_weight( weight, m.date.format('YYYY-MM-DD') )
+        # only the days Smashrun has no weight for yet
+        known = set(str(w.get('date', ''))[:10] for w in client_smashrun.get_weight_history())
+        missing = [(day, weight) for day, (weight, t) in days.items() if day not in known]
+        results = dict(zip([day for day, _ in missing],
+                           client_smashrun.create_weights([(weight, day) for day, weight in missing])))
+
+        num_synced = num_failed = 0
+        failed = set()
+        for day, r in results.items():
+            if isinstance(r, Exception):
+                print("Weight of %s could not be updated to Smashrun: %s" % (day, r))
+                failed.add(day)
+                num_failed += 1
+            elif r is not None:
+                num_synced += 1
+
+        # resume after the last group with no group of a failed day before it
+        cursor = None
+        for seq, day in changes:
+            if day in failed:
+                break
+            cursor = seq
+        if cursor is not None:
+            store.set_cursor('smashrun', cursor)
 
-        if resp.status_code == 200:
-            print('Weight has been successfully updated to Smashrun!')
-            config.set('smashrun','last_sync', str(m.date.timestamp))
+        print('%d weights have been successfully updated to Smashrun!' % num_synced)
+        if num_failed:
+            print("%d weights failed and will be retried on the next sync." % num_failed)
 
     else:
         print('Unknown service (%s), available services are: nokia, garmin, smashrun')
@@ -431,7 +651,7 @@ elif command == 'list_subscriptions':
 
 else:
     print("Unknown command")
-    print("Available commands: setup, sync, sync-preview, last, userinfo, subscribe, unsubscribe, list_subscriptions")
+    print("Available commands: setup, update, sync, sync-preview, last, lastn, userinfo, subscribe, unsubscribe, list_subscriptions")
     sys.exit(1)
 
 save_config()
@@ -36,11 +36,21 @@ __license__ = 'MIT'
 __copyright__ = 'Copyright 2012-2017 Maxime Bouroumeau-Fuseau, and ORCAS'
 
 __all__ = [str('NokiaCredentials'), str('NokiaAuth'), str('NokiaApi'),
-           str('NokiaMeasures'), str('NokiaMeasureGroup')]
+           str('NokiaMeasures'), str('NokiaMeasureGroup'), str('NokiaException'),
+           str('AsyncNokiaApi'), str('MemoryResponseCache'), str('FileResponseCache')]
 
 import arrow
+import asyncio
+import collections
 import datetime
 import json
+import os
+import random
+import requests
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from arrow.parser import ParserError
 from requests_oauthlib import OAuth2Session
@@ -101,6 +111,13 @@ def is_date(key):
     return 'date' in key
 
 
+def parse_date(val):
+    try:
+        return arrow.get(val)
+    except ParserError:
+        return val
+
+
 def is_date_class(val):
     return isinstance(val, (datetime.date, datetime.datetime, arrow.Arrow, ))
 
@@ -114,11 +131,151 @@ def ts():
     ).total_seconds())
 
 
+class NokiaException(Exception):
+    """Error status returned by the Nokia Health API"""
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or "Error code %s" % status)
+        self.status = status
+
+
+class _RetryableError(Exception):
+    """a failed attempt at a request worth retrying, error is raised when no
+    retries are left"""
+
+    def __init__(self, error):
+        Exception.__init__(self, str(error))
+        self.error = error
+
+
+class TokenBucket(object):
+    """Token bucket refilled with rate tokens per second up to capacity,
+    shared between threads"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """take a token, returns how long to wait before using it. Tokens not
+        refilled yet are taken on credit, so waiting needs no lock and can be
+        done with time.sleep() or asyncio.sleep()"""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return max(0, -self._tokens / self.rate)
+
+    def wait(self):
+        """take a token, sleeping until one is available, returns the time
+        slept"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def drain(self):
+        """empty the bucket, e.g. after the server reported throttling"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+
+
+class MemoryResponseCache(object):
+    """Response bodies kept in memory until they expire"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """the cached value, None when missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._changed()
+
+    def invalidate(self, prefix=None):
+        """drop the entries whose key starts with prefix, all when None"""
+        with self._lock:
+            for key in list(self._entries):
+                if prefix is None or key.startswith(prefix):
+                    del self._entries[key]
+            self._changed()
+
+    def _changed(self):
+        pass
+
+
+class FileResponseCache(MemoryResponseCache):
+    """Response bodies kept in a JSON file, so they outlive the process"""
+
+    def __init__(self, path):
+        super(FileResponseCache, self).__init__()
+        self.path = path
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = {}
+        now = time.time()
+        self._entries = dict((key, tuple(entry)) for key, entry in entries.items() if entry[0] > now)
+
+    def _changed(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self.path)
+
+
 class NokiaApi(object):
     URL = 'https://wbsapi.withings.net'
 
-    def __init__(self, credentials):
+    # Withings allows 120 requests per minute. A token bucket lets through
+    # up to capacity + rate * period requests in any period, so the burst
+    # comes out of the quota and the refill rate gets the rest.
+    RATE_LIMIT = (120, 60)
+    RATE_BURST = 10
+    TIMEOUT = 10
+
+    # status codes worth retrying: too many requests, unknown (temporary) error
+    RETRYABLE_STATUS = (601, 2555)
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 1
+    BACKOFF_CAP = 60
+
+    # first day worth looking at for a full history (Withings scales shipped in 2009)
+    BACKFILL_START = 1230768000
+    BACKFILL_WINDOW = 365 * 24 * 3600
+    BACKFILL_WORKERS = 4
+
+    # seconds responses of rarely changing endpoints are cached for
+    CACHE_TTL = {
+        'user/getbyuserid': 24 * 3600,
+        'notify/list': 24 * 3600,
+    }
+
+    def __init__(self, credentials, cache=None):
         self.credentials = credentials
+        self.cache = cache
+        self.cache_ttl = dict(self.CACHE_TTL)
         self.token = {
             'access_token': credentials.access_token,
             'refresh_token': credentials.refresh_token,
@@ -138,10 +295,24 @@ class NokiaApi(object):
             },
             token_updater=self.set_token
         )
+        calls, period = self.RATE_LIMIT
+        self.rate_limiter = TokenBucket(float(calls - self.RATE_BURST) / period, self.RATE_BURST)
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
 
     def get_credentials(self):
         return self.credentials
 
+    def is_token_expired(self, margin=60):
+        return int(self.credentials.token_expiry) - margin <= ts()
+
+    def refresh_token(self):
+        """refresh the access token now instead of on the next failing call"""
+        token = self.client.refresh_token(self.client.auto_refresh_url,
+                                          **self.client.auto_refresh_kwargs)
+        self.set_token(token)
+        return token
+
     def set_token(self, token):
         self.token = token
         self.credentials.token_expiry = str(
@@ -152,21 +323,92 @@ class NokiaApi(object):
 
     def request(self, service, action, params=None, method='GET',
                 version=None):
+        url, params = self._prepare(service, action, params, version)
+        attempt = 0
+        while True:
+            if self.rate_limiter.wait():
+                self._count('throttled')
+            try:
+                return self._send(method, url, params)
+            except _RetryableError as e:
+                time.sleep(self._backoff(attempt, e.error))
+            attempt += 1
+
+    def _prepare(self, service, action, params=None, version=None):
+        """url and params of a request"""
         params = params or {}
         params['userid'] = self.credentials.user_id
         params['action'] = action
         for key, val in params.items():
             if is_date(key) and is_date_class(val):
                 params[key] = arrow.get(val).timestamp
-        url_parts = filter(None, [self.URL, version, service])
-        r = self.client.request(method, '/'.join(url_parts), params=params,timeout=10)
+        return '/'.join(filter(None, [self.URL, version, service])), params
+
+    def _send(self, method, url, params):
+        """one attempt at a request, returns the body of the response, raises
+        _RetryableError when it is worth trying again"""
+        self._count('requests')
+        try:
+            r = self.client.request(method, url, params=params, timeout=self.TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise _RetryableError(NokiaException(None, "Request failed: %s" % e))
+        if r.status_code == 429 or r.status_code >= 500:
+            raise _RetryableError(NokiaException(None, "HTTP error %s" % r.status_code))
         response = json.loads(r.content.decode())
-        if response['status'] != 0:
-            raise Exception("Error code %s" % response['status'])
-        return response.get('body', None)
+        status = response['status']
+        if status == 0:
+            return response.get('body', None)
+        if status not in self.RETRYABLE_STATUS:
+            self._count('failed')
+            raise NokiaException(status)
+        if status == 601:
+            self.rate_limiter.drain()
+        raise _RetryableError(NokiaException(status))
+
+    def _backoff(self, attempt, error):
+        """seconds to wait before retrying after attempt failed with error,
+        raises error when there are no retries left"""
+        if attempt >= self.MAX_RETRIES:
+            self._count('failed')
+            raise error
+        self._count('retried')
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _cache_key(self, endpoint, params=None):
+        key = '%s:%s:' % (self.credentials.user_id, endpoint)
+        if params is not None:
+            key += json.dumps(params, sort_keys=True)
+        return key
+
+    def cached_request(self, endpoint, service, action, params=None, version=None):
+        """request() through the response cache, endpoint names the entry in
+        cache_ttl, responses are not cached without a cache or a ttl"""
+        ttl = self.cache_ttl.get(endpoint)
+        if self.cache is None or not ttl:
+            return self.request(service, action, params, version=version)
+        key = self._cache_key(endpoint, params)
+        body = self.cache.get(key)
+        if body is not None:
+            self._count('cache_hits')
+            return body
+        self._count('cache_misses')
+        body = self.request(service, action, dict(params or {}), version=version)
+        self.cache.set(key, body, ttl)
+        return body
+
+    def invalidate_cache(self, endpoint=None):
+        """forget cached responses of endpoint, or all of this user's"""
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key(endpoint) if endpoint else
+                                  '%s:' % self.credentials.user_id)
 
     def get_user(self):
-        return self.request('user', 'getbyuserid')
+        return self.cached_request('user/getbyuserid', 'user', 'getbyuserid')
 
     def get_activities(self, **kwargs):
         r = self.request('measure', 'getactivity', params=kwargs, version='v2')
@@ -177,6 +419,50 @@ class NokiaApi(object):
         r = self.request('measure', 'getmeas', kwargs)
         return NokiaMeasures(r)
 
+    def iter_measure_pages(self, keep_data=False, **kwargs):
+        """Iterate over the pages of a getmeas query as NokiaMeasures,
+        following more/offset until the whole result has been fetched. The
+        next page is only requested once the current one is consumed."""
+        params = dict(kwargs)
+        while True:
+            r = self.request('measure', 'getmeas', dict(params))
+            yield NokiaMeasures(r, keep_data)
+            if not r.get('more') or 'offset' not in r:
+                break
+            params['offset'] = r['offset']
+
+    def iter_measures(self, keep_data=False, **kwargs):
+        """Iterate over all measure groups of a getmeas query, page by page"""
+        for page in self.iter_measure_pages(keep_data, **kwargs):
+            for group in page:
+                yield group
+
+    def iter_backfill_pages(self, startdate=None, enddate=None, window=None, workers=None, **kwargs):
+        """Fetch a whole measure history in time windows, concurrently.
+
+        The range startdate..enddate (epoch seconds, by default everything
+        up to now) is split into windows which are fetched by a bounded pool
+        of threads, each following its own pagination. Windows are yielded in
+        order as lists of groups sorted by date, groups seen in an earlier
+        window (same grpid) are dropped."""
+        startdate = self.BACKFILL_START if startdate is None else startdate
+        enddate = ts() if enddate is None else enddate
+        window = window or self.BACKFILL_WINDOW
+        windows = [(start, min(start + window - 1, enddate))
+                   for start in range(startdate, enddate + 1, window)]
+
+        def fetch(bounds):
+            groups = list(self.iter_measures(startdate=bounds[0], enddate=bounds[1], **kwargs))
+            groups.sort(key=lambda group: group.timestamp)
+            return groups
+
+        seen = set()
+        with ThreadPoolExecutor(max_workers=workers or self.BACKFILL_WORKERS) as executor:
+            for groups in executor.map(fetch, windows):
+                page = [group for group in groups if group.grpid not in seen]
+                seen.update(group.grpid for group in page)
+                yield page
+
     def get_sleep(self, **kwargs):
         r = self.request('sleep', 'get', params=kwargs, version='v2')
         return NokiaSleep(r)
@@ -185,11 +471,13 @@ class NokiaApi(object):
         params = {'callbackurl': callback_url, 'comment': comment}
         params.update(kwargs)
         self.request('notify', 'subscribe', params)
+        self.invalidate_cache('notify/list')
 
     def unsubscribe(self, callback_url, **kwargs):
         params = {'callbackurl': callback_url}
         params.update(kwargs)
         self.request('notify', 'revoke', params)
+        self.invalidate_cache('notify/list')
 
     def is_subscribed(self, callback_url, appli=1):
         params = {'callbackurl': callback_url, 'appli': appli}
@@ -200,31 +488,167 @@ class NokiaApi(object):
             return False
 
     def list_subscriptions(self, appli=1):
-        r = self.request('notify', 'list', {'appli': appli})
+        r = self.cached_request('notify/list', 'notify', 'list', {'appli': appli})
+        return r['profiles']
+
+
+class AsyncNokiaApi(object):
+    """asyncio interface to the Nokia Health API
+
+    Same methods as NokiaApi, as coroutines, so independent calls (measures,
+    activities, sleep, user...) run concurrently on one event loop. They
+    share the OAuth2 token, rate limiter, retries and response cache of a
+    NokiaApi. An expired token is refreshed once, before the calls that need
+    it are sent.
+
+    Waiting for the rate limiter and backing off before a retry happen on
+    the event loop. Only the HTTP exchange itself runs in an executor (the
+    loop's default one unless given), which holds one thread per request in
+    flight: size it to the number of concurrent requests wanted, e.g.
+    ThreadPoolExecutor(max_workers=100) for a hundred users at once.
+
+    Usage:
+
+    api = AsyncNokiaApi(creds)
+    measures, activities, sleep = await asyncio.gather(
+        api.get_measures(limit=10), api.get_activities(), api.get_sleep())
+
+    """
+
+    def __init__(self, credentials, executor=None):
+        if isinstance(credentials, NokiaApi):
+            self.api = credentials
+        else:
+            self.api = NokiaApi(credentials)
+        self.executor = executor
+        self._refresh_lock = asyncio.Lock()
+
+    def get_credentials(self):
+        return self.api.get_credentials()
+
+    async def _refresh_token(self):
+        async with self._refresh_lock:
+            if self.api.is_token_expired():
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self.api.refresh_token)
+
+    async def request(self, service, action, params=None, method='GET', version=None):
+        await self._refresh_token()
+        loop = asyncio.get_running_loop()
+        api = self.api
+        url, params = api._prepare(service, action, params, version)
+        attempt = 0
+        while True:
+            delay = api.rate_limiter.reserve()
+            if delay:
+                api._count('throttled')
+                await asyncio.sleep(delay)
+            try:
+                return await loop.run_in_executor(self.executor, api._send, method, url, params)
+            except _RetryableError as e:
+                await asyncio.sleep(api._backoff(attempt, e.error))
+            attempt += 1
+
+    async def cached_request(self, endpoint, service, action, params=None, version=None):
+        """see NokiaApi.cached_request"""
+        api = self.api
+        ttl = api.cache_ttl.get(endpoint)
+        if api.cache is None or not ttl:
+            return await self.request(service, action, params, version=version)
+        key = api._cache_key(endpoint, params)
+        body = api.cache.get(key)
+        if body is not None:
+            api._count('cache_hits')
+            return body
+        api._count('cache_misses')
+        body = await self.request(service, action, dict(params or {}), version=version)
+        api.cache.set(key, body, ttl)
+        return body
+
+    async def get_user(self):
+        return await self.cached_request('user/getbyuserid', 'user', 'getbyuserid')
+
+    async def get_activities(self, **kwargs):
+        r = await self.request('measure', 'getactivity', params=kwargs, version='v2')
+        activities = r['activities'] if 'activities' in r else [r]
+        return [NokiaActivity(act) for act in activities]
+
+    async def get_measures(self, **kwargs):
+        r = await self.request('measure', 'getmeas', kwargs)
+        return NokiaMeasures(r)
+
+    async def get_sleep(self, **kwargs):
+        r = await self.request('sleep', 'get', params=kwargs, version='v2')
+        return NokiaSleep(r)
+
+    async def subscribe(self, callback_url, comment, **kwargs):
+        params = {'callbackurl': callback_url, 'comment': comment}
+        params.update(kwargs)
+        await self.request('notify', 'subscribe', params)
+        self.api.invalidate_cache('notify/list')
+
+    async def unsubscribe(self, callback_url, **kwargs):
+        params = {'callbackurl': callback_url}
+        params.update(kwargs)
+        await self.request('notify', 'revoke', params)
+        self.api.invalidate_cache('notify/list')
+
+    async def is_subscribed(self, callback_url, appli=1):
+        params = {'callbackurl': callback_url, 'appli': appli}
+        try:
+            await self.request('notify', 'get', params)
+            return True
+        except:
+            return False
+
+    async def list_subscriptions(self, appli=1):
+        r = await self.cached_request('notify/list', 'notify', 'list', {'appli': appli})
         return r['profiles']
 
 
 class NokiaObject(object):
+    __slots__ = ()  # subclasses without __slots__ still get a __dict__
+
     def __init__(self, data):
         self.set_attributes(data)
 
     def set_attributes(self, data):
         self.data = data
+        self._raw_dates = {}
         for key, val in data.items():
-            try:
-                setattr(self, key, arrow.get(val) if is_date(key) else val)
-            except ParserError:
+            if is_date(key):
+                self._raw_dates[key] = val
+            else:
                 setattr(self, key, val)
 
+    def __getattr__(self, name):
+        # only reached for names that are not set: dates are kept raw and
+        # parsed into arrow objects when first read
+        try:
+            raw_dates = object.__getattribute__(self, '_raw_dates')
+        except AttributeError:
+            raise AttributeError(name)
+        if name not in raw_dates:
+            raise AttributeError(name)
+        val = parse_date(raw_dates[name])
+        setattr(self, name, val)
+        return val
+
+    def get_raw_date(self, key):
+        """the unparsed value of a date attribute, e.g. epoch seconds"""
+        return self._raw_dates[key]
+
 
 class NokiaActivity(NokiaObject):
     pass
 
 
 class NokiaMeasures(list, NokiaObject):
-    def __init__(self, data):
+    def __init__(self, data, keep_data=False):
         super(NokiaMeasures, self).__init__(
-            [NokiaMeasureGroup(g) for g in data['measuregrps']])
+            [NokiaMeasureGroup(g, keep_data) for g in data['measuregrps']])
+        if not keep_data:
+            data = dict((key, val) for key, val in data.items() if key != 'measuregrps')
         self.set_attributes(data)
 
 
@@ -248,10 +672,58 @@ class NokiaMeasureGroup(NokiaObject):
         ('pulse_wave_velocity', 91)
     )
 
-    def __init__(self, data):
-        super(NokiaMeasureGroup, self).__init__(data)
-        for n, t in self.MEASURE_TYPES:
-            self.__setattr__(n, self.get_measure(t))
+    # group attributes kept from the getmeas response, dates are stored raw
+    # in _raw_<name> and parsed when first read
+    ATTRIBUTES = ('grpid', 'attrib', 'date', 'created', 'modified', 'category', 'deviceid',
+                  'hash_deviceid', 'model', 'modelid', 'timezone', 'comment')
+    DATE_ATTRIBUTES = tuple(key for key in ATTRIBUTES if is_date(key))
+
+    __slots__ = ATTRIBUTES + ('data', 'measures', '_values') + tuple('_raw_' + key for key in DATE_ATTRIBUTES)
+
+    _SLOTS = tuple((key, '_raw_' + key if is_date(key) else key) for key in ATTRIBUTES)
+    _TYPES = dict(MEASURE_TYPES)
+    _SCALES = dict((unit, 10 ** unit) for unit in range(-10, 11))
+
+    def __init__(self, data, keep_data=False):
+        """the raw data (and measures) are only kept when keep_data is set,
+        measures are indexed by type and available as attributes by name"""
+        self.set_attributes(data, keep_data)
+        scales = self._SCALES
+        values = {}
+        for m in data['measures']:
+            unit = m['unit']
+            scale = scales[unit] if unit in scales else 10 ** unit
+            if m['type'] not in values:
+                values[m['type']] = m['value'] * scale
+        self._values = values
+
+    def set_attributes(self, data, keep_data=False):
+        if keep_data:
+            self.data = data
+            self.measures = data['measures']
+        for key, slot in self._SLOTS:
+            if key in data:
+                setattr(self, slot, data[key])
+
+    def __getattr__(self, name):
+        # only reached for names that are not set: measures by name or dates
+        # that were not parsed yet
+        measure_type = self._TYPES.get(name)
+        if measure_type is not None:
+            return self._values.get(measure_type)
+        if name not in self.DATE_ATTRIBUTES:
+            raise AttributeError(name)
+        val = parse_date(self.get_raw_date(name))
+        setattr(self, name, val)
+        return val
+
+    def get_raw_date(self, key):
+        return getattr(self, '_raw_' + key)
+
+    @property
+    def timestamp(self):
+        """epoch seconds of the group date, without parsing it"""
+        return int(self._raw_date)
 
     def is_ambiguous(self):
         return self.attrib == 1 or self.attrib == 4
@@ -263,10 +735,7 @@ class NokiaMeasureGroup(NokiaObject):
         return self.category == 2
 
     def get_measure(self, measure_type):
-        for m in self.measures:
-            if m['type'] == measure_type:
-                return m['value'] * pow(10, m['unit'])
-        return None
+        return self._values.get(measure_type)
 
 
 class NokiaSleepSeries(NokiaObject):
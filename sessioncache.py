@@ -1,38 +1,226 @@
-# From https://github.com/cpfair/tapiriik
+# From https://github.com/cpfair/tapiriik (Apache License 2.0)
+#
+# Modified for nokia-weight-sync: size limit with LRU eviction, monotonic
+# expiry, periodic sweeps, locking, hit/miss counts and memory, file and
+# SQLite backends. The Get/Set interface is unchanged.
 
-from datetime import datetime
+from datetime import timedelta
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
 
 class SessionCache:
-	def __init__(self, lifetime, freshen_on_get=False):
-		self._lifetime = lifetime
+	"""LRU cache of sessions expiring lifetime after they were set (or last
+	read, with freshen_on_get), keeping at most max_size entries
+
+	Expired entries are swept every sweep_interval (the lifetime by default)
+	besides being dropped when read. The entries live in a backend: memory by
+	default, or a file or SQLite backend to share them between processes."""
+	def __init__(self, lifetime, freshen_on_get=False, max_size=None, backend=None, sweep_interval=None):
+		self._lifetime = lifetime.total_seconds() if isinstance(lifetime, timedelta) else lifetime
 		self._autorefresh = freshen_on_get
-		self._cache = {}
+		self._max_size = max_size
+		self._backend = backend if backend is not None else MemorySessionCacheBackend()
+		if isinstance(sweep_interval, timedelta):
+			sweep_interval = sweep_interval.total_seconds()
+		self._sweep_interval = sweep_interval if sweep_interval is not None else self._lifetime
+		self._lock = threading.RLock()
+		self._next_sweep = self._backend.Clock() + self._sweep_interval
+		self.Hits = 0
+		self.Misses = 0
+
+	def _maybeSweep(self, now):
+		if now >= self._next_sweep:
+			self._backend.Sweep(now)
+			self._next_sweep = now + self._sweep_interval
 
 	def Get(self, pk, freshen=False):
-		if pk not in self._cache:
-			return
-		record = self._cache[pk]
-		if record.Expired():
-			del self._cache[pk]
-			return None
-		if self._autorefresh or freshen:
-			record.Refresh()
-		return record.Get()
+		with self._lock:
+			now = self._backend.Clock()
+			self._maybeSweep(now)
+			record = self._backend.Get(pk)
+			if record is not None and record[0] < now:
+				self._backend.Delete(pk)
+				record = None
+			if record is None:
+				self.Misses += 1
+				return None
+			if self._autorefresh or freshen:
+				self._backend.Touch(pk, now + self._lifetime)
+			self.Hits += 1
+			return record[1]
 
 	def Set(self, pk, value):
-		self._cache[pk] = SessionCacheRecord(value, self._lifetime)
+		with self._lock:
+			now = self._backend.Clock()
+			self._maybeSweep(now)
+			self._backend.Set(pk, now + self._lifetime, value)
+			if self._max_size is not None:
+				self._backend.Evict(self._max_size)
+
+	def Delete(self, pk):
+		with self._lock:
+			self._backend.Delete(pk)
+
+	def Sweep(self):
+		with self._lock:
+			now = self._backend.Clock()
+			self._backend.Sweep(now)
+			self._next_sweep = now + self._sweep_interval
+
+	def Stats(self):
+		with self._lock:
+			return {"hits": self.Hits, "misses": self.Misses, "size": self._backend.Count()}
+
+class MemorySessionCacheBackend:
+	"""Entries in an ordered dict, least recently used first"""
+	Clock = staticmethod(time.monotonic)
+
+	def __init__(self):
+		self._entries = OrderedDict()
+
+	def Get(self, pk):
+		record = self._entries.get(pk)
+		if record is not None:
+			self._entries.move_to_end(pk)
+		return record
+
+	def Set(self, pk, expires, value):
+		self._entries[pk] = (expires, value)
+		self._entries.move_to_end(pk)
+
+	def Touch(self, pk, expires):
+		if pk in self._entries:
+			self._entries[pk] = (expires, self._entries[pk][1])
+
+	def Delete(self, pk):
+		self._entries.pop(pk, None)
+
+	def Sweep(self, now):
+		for pk in [pk for pk, record in self._entries.items() if record[0] < now]:
+			del self._entries[pk]
+
+	def Evict(self, max_size):
+		while len(self._entries) > max_size:
+			self._entries.popitem(last=False)
+
+	def Count(self):
+		return len(self._entries)
+
+class FileSessionCacheBackend:
+	"""Entries pickled one per file in a directory, the modification time
+	tracks their last use. Persistent entries expire by the wall clock, the
+	monotonic clock does not survive a reboot."""
+	Clock = staticmethod(time.time)
+
+	def __init__(self, path):
+		self._path = path
+		os.makedirs(path, exist_ok=True)
+
+	def _file(self, pk):
+		return os.path.join(self._path, hashlib.sha1(repr(pk).encode("utf-8")).hexdigest() + ".session")
+
+	def _files(self):
+		return [os.path.join(self._path, name) for name in os.listdir(self._path) if name.endswith(".session")]
+
+	def _read(self, path):
+		try:
+			with open(path, "rb") as f:
+				return pickle.load(f)
+		except (IOError, EOFError, pickle.UnpicklingError):
+			return None
+
+	def _write(self, path, record):
+		tmp = "%s.%d.tmp" % (path, os.getpid())
+		with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+			pickle.dump(record, f)
+		os.replace(tmp, path)
+
+	def _remove(self, path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+	def Get(self, pk):
+		path = self._file(pk)
+		record = self._read(path)
+		if record is None:
+			return None
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+		return record[1:]
+
+	def Set(self, pk, expires, value):
+		self._write(self._file(pk), (pk, expires, value))
+
+	def Touch(self, pk, expires):
+		path = self._file(pk)
+		record = self._read(path)
+		if record is not None:
+			self._write(path, (pk, expires, record[2]))
+
+	def Delete(self, pk):
+		self._remove(self._file(pk))
+
+	def Sweep(self, now):
+		for path in self._files():
+			record = self._read(path)
+			if record is None or record[1] < now:
+				self._remove(path)
+
+	def Evict(self, max_size):
+		files = []
+		for path in self._files():
+			try:
+				files.append((os.path.getmtime(path), path))
+			except OSError:
+				pass
+		files.sort()
+		for _, path in files[:max(len(files) - max_size, 0)]:
+			self._remove(path)
+
+	def Count(self):
+		return len(self._files())
+
+class SQLiteSessionCacheBackend:
+	"""Entries pickled in a SQLite table, shared by every process opening the
+	same database. Expiry is by the wall clock, as for files."""
+	Clock = staticmethod(time.time)
+
+	def __init__(self, path):
+		self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+		self._db.execute("CREATE TABLE IF NOT EXISTS sessions (pk TEXT PRIMARY KEY, expires REAL NOT NULL, used REAL NOT NULL, value BLOB NOT NULL)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS sessions_used ON sessions (used)")
+
+	def Get(self, pk):
+		row = self._db.execute("SELECT expires, value FROM sessions WHERE pk = ?", (repr(pk),)).fetchone()
+		if row is None:
+			return None
+		self._db.execute("UPDATE sessions SET used = ? WHERE pk = ?", (time.time(), repr(pk)))
+		return (row[0], pickle.loads(row[1]))
+
+	def Set(self, pk, expires, value):
+		self._db.execute("INSERT OR REPLACE INTO sessions (pk, expires, used, value) VALUES (?, ?, ?, ?)",
+			(repr(pk), expires, time.time(), pickle.dumps(value)))
+
+	def Touch(self, pk, expires):
+		self._db.execute("UPDATE sessions SET expires = ? WHERE pk = ?", (expires, repr(pk)))
 
-class SessionCacheRecord:
-	def __init__(self, data, lifetime):
-		self._value = data
-		self._lifetime = lifetime
-		self.Refresh()
+	def Delete(self, pk):
+		self._db.execute("DELETE FROM sessions WHERE pk = ?", (repr(pk),))
 
-	def Expired(self):
-		return self._timestamp < datetime.utcnow() - self._lifetime
+	def Sweep(self, now):
+		self._db.execute("DELETE FROM sessions WHERE expires < ?", (now,))
 
-	def Refresh(self):
-		self._timestamp = datetime.utcnow()
+	def Evict(self, max_size):
+		self._db.execute("DELETE FROM sessions WHERE pk IN (SELECT pk FROM sessions ORDER BY used DESC LIMIT -1 OFFSET ?)", (max_size,))
 
-	def Get(self):
-		return self._value
+	def Count(self):
+		return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
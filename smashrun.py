@@ -3,8 +3,10 @@
 """
 from __future__ import division
 
+import collections
 import json
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
 
 from requests_oauthlib import OAuth2Session
@@ -14,14 +16,26 @@ token_url = "https://secure.smashrun.com/oauth2/token"
 
 
 class Smashrun(object):
+    # concurrent requests for bulk submissions
+    max_workers = 4
+    # results per page and pages requested ahead when iterating
+    page_size = 10
+    prefetch = 2
+
     def __init__(self, client_id=None, client_secret=None, client=None,
                  auto_refresh_url=None, auto_refresh_kwargs=None, scope=None,
                  redirect_uri=None, token=None, state=None, token_updater=None,
                  **kwargs):
+        # lets the session refresh an expired token by itself, the new token
+        # is handed to token_updater
+        if auto_refresh_kwargs is None and client_secret:
+            auto_refresh_kwargs = {'client_id': client_id,
+                                   'client_secret': client_secret}
         self.session = OAuth2Session(
             client_id=client_id,
             client=client,
-            auto_refresh_url=token_url,
+            auto_refresh_url=auto_refresh_url or token_url,
+            auto_refresh_kwargs=auto_refresh_kwargs,
             scope=scope,
             redirect_uri=redirect_uri,
             token=token,
@@ -73,11 +87,12 @@ class Smashrun(object):
         url = self._build_url('my', 'activities', id_num)
         return self._json(url)
 
-    def get_activities(self, count=10, since=None, style='summary',
-                       limit=None):
+    def get_activities(self, count=None, since=None, style='summary',
+                       limit=None, prefetch=None):
         """Iterate over all activities, from newest to oldest.
 
-        :param count: The number of results to retrieve per page.
+        :param count: The number of results to retrieve per page,
+                      `page_size` of the client by default.
         :param since: Return only activities since this date. Can be either
                       a timestamp or a datetime object.
 
@@ -87,6 +102,10 @@ class Smashrun(object):
         :param limit: The maximum number of activities to return for the given
                       query.
 
+        :param prefetch: The number of pages requested ahead while the
+                         current one is consumed, `prefetch` of the client by
+                         default.
+
         """
         params = {}
         if since:
@@ -97,7 +116,7 @@ class Smashrun(object):
         url = self._build_url(*parts)
         # TODO: return an Activity (or ActivitySummary?) class that can do
         # things like convert date and time fields to proper datetime objects
-        return islice(self._iter(url, count, **params), limit)
+        return islice(self._iter(url, count or self.page_size, prefetch=prefetch, **params), limit)
 
     def get_badges(self):
         """Return all badges the user has earned."""
@@ -184,6 +203,26 @@ class Smashrun(object):
         r.raise_for_status()
         return r
 
+    def create_weights(self, weights, max_workers=None):
+        """Submit several weight records concurrently.
+
+        :param weights: (weight, date) pairs, as for `create_weight`.
+        :param max_workers: The number of requests in flight at once,
+                            `max_workers` of the client by default.
+
+        Return a list with the response, or the exception raised, for each
+        pair in order.
+
+        """
+        def submit(pair):
+            try:
+                return self.create_weight(*pair)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            return list(executor.map(submit, weights))
+
     def create_activity(self, data):
         """Create a new activity (run).
 
@@ -225,21 +264,37 @@ class Smashrun(object):
         r.raise_for_status()
         return r
 
-    def _iter(self, url, count, cls=None, **kwargs):
-        page = 0
-        while True:
-            kwargs.update(count=count, page=page)
-            r = self.session.get(url, params=kwargs)
+    def _iter(self, url, count, cls=None, prefetch=None, **kwargs):
+        # the next pages are requested in the background while the current
+        # one is consumed, until a page comes back empty
+        if prefetch is None:
+            prefetch = self.prefetch
+
+        def fetch(page):
+            r = self.session.get(url, params=dict(kwargs, count=count, page=page))
             r.raise_for_status()
-            data = r.json()
-            if not data:
-                break
-            for d in data:
-                if cls:
-                    yield cls(d)
-                else:
-                    yield d
-            page += 1
+            return r.json()
+
+        executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        pending = collections.deque()
+        page = 0
+        try:
+            while True:
+                while len(pending) <= prefetch:
+                    pending.append(executor.submit(fetch, page))
+                    page += 1
+                data = pending.popleft().result()
+                if not data:
+                    break
+                for d in data:
+                    if cls:
+                        yield cls(d)
+                    else:
+                        yield d
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def _build_url(self, *args, **kwargs):
         parts = [kwargs.get('base_url') or self.base_url]
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import threading
+import unittest
+from struct import unpack
+
+import fit
+
+
+def _baseline_crc(data):
+    """the nibble table CRC the encoder used before the running CRC"""
+    table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+    crc = 0
+    for byte in bytearray(data):
+        tmp = table[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ table[byte & 0xF]
+        tmp = table[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ table[(byte >> 4) & 0xF]
+    return crc
+
+
+# five weigh-ins with every weight_scale field set, as encoded by the
+# original FitEncoder_Weight
+BASELINE_WEIGHT_FILE = bytes.fromhex(
+    '0c106c002e0100002e46495440000000000603048c0404860102840202840502840001000000000000c0d6ac34'
+    'ffffffffffff0941000031000200028401010201ffffff4300001e000dfd04860002840102840202840302840402'
+    '840502840702840902840801020a01020b01020d028403c0d6ac34401fda079015960036019817201c8025051e07'
+    'f600034028ae340e1fe4079015960036019817201c8025051e07f60003c079af34dc1eee07901596003601981720'
+    '1c8025051e07f6000340cbb034aa1ef8079015960036019817201c8025051e07f60003c01cb234781e0208901596'
+    '0036019817201c8025051e07f60042000017000cfd048603048c0704860804860202840402840502840a02840001'
+    '020101020601020b010202c01cb23400000000ffffffffffffffffffffffffffffffffffffffff5951')
+
+START = 1514808000
+DAY = 86400
+
+
+def encode_full_weights():
+    encoder = fit.FitEncoder_Weight()
+    encoder.write_file_info(time_created=START)
+    encoder.write_file_creator()
+    for i in range(5):
+        encoder.write_weight_scale(START + i * DAY, 80.0 - i * 0.5, percent_fat=20.1 + i / 10,
+                                   percent_hydration=55.2, visceral_fat_mass=1.5, bone_mass=3.1,
+                                   muscle_mass=60.4, basal_met=1800, active_met=2400, physique_rating=5,
+                                   metabolic_age=30, visceral_fat_rating=7, bmi=24.6)
+    encoder.write_device_info(START + 4 * DAY)
+    encoder.finish()
+    return encoder.getvalue()
+
+
+def encode_sparse_weights():
+    encoder = fit.FitEncoder_Weight()
+    encoder.write_file_info(time_created=START)
+    encoder.write_file_creator()
+    for i in range(50):
+        encoder.write_weight_scale(START + i * DAY, 75.0 + (i % 7) / 10,
+                                   percent_fat=None if i % 3 == 0 else 18.5, bmi=23.1)
+    encoder.write_device_info(START + 49 * DAY)
+    encoder.finish()
+    return encoder.getvalue()
+
+
+def encode_batch_weights():
+    count = 365
+    encoder = fit.FitEncoder_Weight()
+    encoder.write_file_info(time_created=START)
+    encoder.write_file_creator()
+    encoder.write_weight_scale_batch(
+        timestamp=[START + i * DAY for i in range(count)],
+        weight=[70 + (i % 11) / 10 for i in range(count)],
+        percent_fat=[None if i % 5 == 0 else 21.3 for i in range(count)],
+        bone_mass=[3.2] * count)
+    encoder.write_device_info(START + (count - 1) * DAY)
+    encoder.finish()
+    return encoder.getvalue()
+
+
+class CRCTest(unittest.TestCase):
+
+    def test_baseline_bytes(self):
+        self.assertEqual(encode_full_weights(), BASELINE_WEIGHT_FILE)
+
+    def test_crc_matches_baseline(self):
+        for data in (BASELINE_WEIGHT_FILE, encode_full_weights(), encode_sparse_weights(),
+                     encode_batch_weights()):
+            self.assertEqual(unpack('<H', data[-2:])[0], _baseline_crc(data[:-2]))
+            self.assertEqual(fit._calcCRC(0, data[:-2]), _baseline_crc(data[:-2]))
+            # a FIT file including its CRC checks to zero
+            self.assertEqual(fit._calcCRC(0, data), 0)
+
+    def test_combine(self):
+        rng = random.Random(1)
+        for len1 in (0, 1, 12, 100):
+            a = bytes(rng.randrange(256) for _ in range(len1))
+            for len2 in (0, 1, 2, 3, 15, 16, 255, 256, 1000, 4099):
+                b = bytes(rng.randrange(256) for _ in range(len2))
+                self.assertEqual(fit._combineCRC(fit._calcCRC(0, a), fit._calcCRC(0, b), len(b)),
+                                 fit._calcCRC(0, a + b))
+
+    def test_decoder_verify(self):
+        for data in (encode_full_weights(), encode_sparse_weights(), encode_batch_weights()):
+            self.assertTrue(fit.FitDecoder(data).verify())
+
+    def test_decoder_truncated_or_corrupt(self):
+        data = encode_sparse_weights()
+        rng = random.Random(2)
+        damaged = [data[:size] for size in range(fit.Fit.HEADER_SIZE, len(data))]
+        for _ in range(200):
+            corrupt = bytearray(data)
+            for _ in range(3):
+                corrupt[rng.randrange(fit.Fit.HEADER_SIZE, len(data))] = rng.randrange(256)
+            damaged.append(bytes(corrupt))
+        for sample in damaged:
+            # only ValueError, whatever the damage
+            try:
+                list(fit.FitDecoder(sample).records())
+            except ValueError:
+                pass
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_intermittent_field_keeps_definition(self):
+        def encode(fat):
+            encoder = fit.FitEncoder_Weight()
+            for i in range(500):
+                encoder.write_weight_scale(START + i * DAY, 80.0, percent_fat=fat(i))
+            encoder.finish()
+            return encoder.getvalue()
+
+        intermittent = encode(lambda i: None if i % 3 == 0 else 20.0)
+        always = encode(lambda i: 20.0)
+        # only the first record, without fat, has a definition of its own
+        first = fit.FitEncoder_Weight.compile('weight_scale', fit.FitEncoder_Weight.LMSG_TYPE_WEIGHT_SCALE,
+                                              ('timestamp', 'weight'))
+        self.assertEqual(len(intermittent) - len(always), len(first.definition) - 2)
+
+    def test_encoders_in_threads(self):
+        # compiled definitions are shared, record buffers must not be
+        expected = encode_sparse_weights()
+        results = []
+
+        def encode():
+            for _ in range(20):
+                results.append(encode_sparse_weights())
+
+        threads = [threading.Thread(target=encode) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 80)
+        self.assertTrue(all(result == expected for result in results))
+
+
+    def test_sink_keeping_references(self):
+        class ListSink(object):
+            # keeps what it is given, like a queue feeding a request body
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(data)
+
+        sink = ListSink()
+        encoder = fit.FitEncoder_Weight(sink=sink, data_size=fit.FitEncoder_Weight.expected_data_size(3))
+        encoder.write_file_info(time_created=START)
+        encoder.write_file_creator()
+        for i in range(3):
+            encoder.write_weight_scale(START + i * DAY, 80.0 - i, percent_fat=20.0, percent_hydration=55.0,
+                                       visceral_fat_mass=1.5, bone_mass=3.0, muscle_mass=60.0, basal_met=1800,
+                                       active_met=2400, physique_rating=5, metabolic_age=30,
+                                       visceral_fat_rating=7, bmi=24.0)
+        encoder.write_device_info(START + 2 * DAY)
+        encoder.finish()
+        self.assertTrue(fit.FitDecoder(b''.join(sink.chunks)).verify())
+
+    def stream_to_pipe(self, encode, data_size):
+        read_fd, write_fd = os.pipe()
+        chunks = []
+        reader = threading.Thread(target=lambda: chunks.append(os.fdopen(read_fd, 'rb').read()))
+        reader.start()
+        with os.fdopen(write_fd, 'wb') as sink:
+            encode(sink, data_size)
+        reader.join()
+        data = chunks[0]
+        self.assertTrue(fit.FitDecoder(data).verify())
+        return data
+
+    def test_weight_expected_data_size(self):
+        def encode(sink, data_size):
+            encoder = fit.FitEncoder_Weight(sink=sink, data_size=data_size)
+            encoder.write_file_info(time_created=START)
+            encoder.write_file_creator()
+            encoder.write_weight_scale_batch(timestamp=[START, START + DAY], weight=[80, 79.5],
+                                             bmi=[24.1, None])
+            encoder.write_device_info(START + DAY)
+            encoder.finish()
+
+        size = fit.FitEncoder_Weight.expected_data_size(2, weight_scale_fields=('bmi',))
+        data = self.stream_to_pipe(encode, size)
+        self.assertEqual(fit.FitDecoder(data).header()[3], size)
+
+    def test_blood_pressure_file(self):
+        def encode(sink, data_size):
+            encoder = fit.FitEncoder_BloodPressure(sink=sink, data_size=data_size)
+            encoder.write_file_info(time_created=START)
+            encoder.write_file_creator()
+            encoder.write_blood_pressure_batch(timestamp=[START, START + DAY], systolic_pressure=[120, 118],
+                                               diastolic_pressure=[80, 79], heart_rate=[61, 64])
+            encoder.write_device_info(START + DAY)
+            encoder.finish()
+
+        size = fit.FitEncoder_BloodPressure.expected_data_size(2, blood_pressure_fields=('heart_rate',))
+        data = self.stream_to_pipe(encode, size)
+        records = list(fit.FitDecoder(data).records())
+        file_id = [record for record in records if record.gmsg_num == fit.Fit.GMSG_NUMS['file_id']][0]
+        self.assertEqual(file_id.fields[0], fit.FitEncoder_BloodPressure.FILE_TYPE)
+        self.assertEqual(len([record for record in records
+                              if record.gmsg_num == fit.Fit.GMSG_NUMS['blood_pressure']]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
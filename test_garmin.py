@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import unittest
+
+import garmin
+
+START = 1514808000
+DAY = 86400
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+class FakeSession(object):
+    """stand-in for a logged in Garmin Connect session, answering the weight
+    query with the given dateWeightList"""
+
+    def __init__(self, weigh_ins, status_code=200):
+        self.weigh_ins = weigh_ins
+        self.status_code = status_code
+        self.requests = []
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append((url, params))
+        return FakeResponse(self.status_code, {'dateWeightList': self.weigh_ins})
+
+
+def local_day_ms(t, offset):
+    """the "date" Garmin Connect gives a weigh-in: midnight of its day in a
+    time zone offset seconds from UTC, in milliseconds"""
+    day = datetime.datetime.fromtimestamp(t + offset, datetime.timezone.utc).date()
+    return int(datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc).timestamp() - offset) * 1000
+
+
+class WeighInTest(unittest.TestCase):
+
+    def test_query_range(self):
+        session = FakeSession([])
+        garmin.GarminConnect().get_weigh_ins(session, START, START + 2 * DAY)
+        url, params = session.requests[0]
+        self.assertEqual(url, garmin.GarminConnect.WEIGHT_URL)
+        # a day more on both sides for the account's time zone
+        self.assertEqual(params, {'startDate': '2017-12-31', 'endDate': '2018-01-04'})
+
+    def test_present_filtering(self):
+        offset = -5 * 3600
+        weighings = [START + i * DAY + 7 * 3600 for i in range(4)]
+        # Garmin Connect has the first two, one of them without timestampGMT
+        session = FakeSession([
+            {'timestampGMT': weighings[0] * 1000, 'date': local_day_ms(weighings[0], offset), 'weight': 80000},
+            {'date': local_day_ms(weighings[1], offset), 'weight': 79500},
+        ])
+        present = garmin.GarminConnect().get_weigh_ins(session, weighings[0], weighings[-1])
+        self.assertEqual(present, {weighings[0]})
+        # the local date is never taken for a weigh-in time
+        self.assertNotIn(local_day_ms(weighings[0], offset) // 1000, present)
+        self.assertEqual([t for t in weighings if t not in present], weighings[1:])
+
+    def test_bad_response(self):
+        with self.assertRaises(garmin.APIException):
+            garmin.GarminConnect().get_weigh_ins(FakeSession([], status_code=500), START, START)
+
+
+if __name__ == '__main__':
+    unittest.main()